@@ -36,6 +36,21 @@ class OtaControlServicer(ota_pb2_grpc.OtaControlServicer):
         return ota_pb2.RegisterManifestResponse(success=True, message="Stored")
     
     def UpdateJobStatus(self, request, context):
+        self.apply_job_status(request)
+        return ota_pb2.UpdateJobStatusResponse(received=True)
+
+    def UpdateJobStatusBatch(self, request, context):
+        for update in request.updates:
+            self.apply_job_status(update)
+        return ota_pb2.UpdateJobStatusBatchResponse(received=len(request.updates))
+
+    def StreamJobStatus(self, request_iterator, context):
+        # One ack per update, so a broken stream costs the client only its unacknowledged tail
+        for update in request_iterator:
+            self.apply_job_status(update)
+            yield ota_pb2.UpdateJobStatusResponse(received=True)
+
+    def apply_job_status(self, request):
         job_id = request.job_id
         if job_id not in JOBS:
             JOBS[job_id] = {}
@@ -48,7 +63,6 @@ class OtaControlServicer(ota_pb2_grpc.OtaControlServicer):
             "status": request.status, 
             "details": request.details
         })
-        return ota_pb2.UpdateJobStatusResponse(received=True)
     
     def GetManifest(self, request, context):
         ref = request.manifest_ref
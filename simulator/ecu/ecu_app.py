@@ -1,6 +1,6 @@
-import os, time, base64, hashlib, sys
+import os, time, base64, hashlib, sys, zlib
 from cryptography.hazmat.primitives.asymmetric import ed25519
-from can_bus import CanRPC
+from can_bus import CanRPC, CODEC_JSON, CODEC_BINARY
 from trace_logger import TraceLogger
 
 # Configuration
@@ -18,6 +18,13 @@ CAN_IDS = {
 LISTEN_ID = CAN_IDS.get(ECU_ID, 0x000)
 REPLY_ID  = LISTEN_ID + 1
 
+# Flow control limits this ECU grants for windowed write_block transfers
+FC_MAX_BLOCK_SIZE = int(os.getenv("FC_MAX_BLOCK_SIZE", "16"))
+FC_MIN_ST_MS = int(os.getenv("FC_MIN_ST_MS", "0"))
+
+# Bytes of SHA-256 kept per block in block_hashes answers
+BLOCK_DIGEST_BYTES = 8
+
 if LISTEN_ID == 0:
     print(f"Unknown ECU ID: {ECU_ID}")
     sys.exit(1)
@@ -26,15 +33,24 @@ print(f"ECU {ECU_ID} starting on CAN Bus (Listen: {hex(LISTEN_ID)})...")
 
 # State Machine
 state = {
-    "mode": "IDLE", # IDLE, PROGRAMMING, VERIFIED, ACTIVATED, CONFIRMED
-    "buffer": bytearray(),
+    "mode": "IDLE", # IDLE, PROGRAMMING, VERIFIED, ACTIVATED, CONFIRMED, ROLLED_BACK
+    "buffer": bytearray(), # Preallocated to expected_size in enter_programming
+    "view": memoryview(b""), # Writable view of buffer, slice-assigned without copies
+    "hasher": None,         # Running SHA-256 over buffer[:next_offset]
+    "hash_in_order": True,  # False once a write changes hashed bytes; verify then rehashes
+    "ahead": {},            # offset -> end of blocks written past a gap in the prefix
     "expected_size": 0,
     "expected_sha256": None,
-    "expected_signature": None
+    "expected_signature": None,
+    "codec": CODEC_JSON,
+    "bs": 1,           # Blocks per acknowledged window
+    "window_count": 0, # Blocks received since the last ack
+    "next_offset": 0   # Highest contiguous offset written so far
 }
 
 slots = {"current": "A", "target": "B"}
 versions = {"A": "1.0.0", "B": None}
+images = {"A": b"A" * 4096, "B": None} # Slot contents; A is the mock V1 the gateway patches against
 pub_key = ed25519.Ed25519PublicKey.from_public_bytes(base64.b64decode(PUB_KEY_B64))
 
 can_rpc = CanRPC(LISTEN_ID)
@@ -43,8 +59,51 @@ def fail(reason):
     print(f"ERROR: {reason}")
     return {"ok": False, "error": reason}
 
-def success():
-    return {"ok": True}
+def success(**extra):
+    return {"ok": True, **extra}
+
+def read_block(params):
+    """
+    Returns the raw block bytes of a write_block call in any of its encodings.
+    """
+    if "block" in params:
+        return params["block"] # Raw bytes from the binary codec
+    if "block_z" in params or "block_z_b64" in params:
+        z = params["block_z"] if "block_z" in params else base64.b64decode(params["block_z_b64"])
+        block = zlib.decompress(z)
+        if len(block) != params.get("length"):
+            raise zlib.error(f"length {len(block)} != {params.get('length')}")
+        return block
+    return base64.b64decode(params.get("block_b64"))
+
+def store_block(offset, block):
+    """
+    Writes a block into the preallocated buffer and keeps the running hash
+    over the contiguous prefix. Blocks past a gap wait in the buffer and are
+    hashed once the gap is filled.
+    """
+    end = offset + len(block)
+    prefix = state["next_offset"]
+    held = min(end, prefix)
+    if offset < held and state["view"][offset:held] != block[:held - offset]:
+        # Changes bytes already hashed: the running hash no longer matches the buffer
+        state["hash_in_order"] = False
+    state["view"][offset:end] = block
+    if offset > prefix:
+        state["ahead"][offset] = max(end, state["ahead"].get(offset, 0))
+        return
+    extend_prefix(end)
+
+def extend_prefix(end):
+    # Hash up to end, then on over the held blocks that now join the prefix
+    while end > state["next_offset"]:
+        if state["hash_in_order"]:
+            state["hasher"].update(state["view"][state["next_offset"]:end])
+        state["next_offset"] = end
+        for start, stop in list(state["ahead"].items()):
+            if start <= state["next_offset"]:
+                del state["ahead"][start]
+                end = max(end, stop)
 
 def handle_rpc(method, params):
     global state
@@ -52,34 +111,96 @@ def handle_rpc(method, params):
     
     if method == "enter_programming":
         params = params or {}
+        # Keep the partial image if the gateway resumes the same one right where we stand
+        resume = params.get("resume_offset", 0)
+        resumed = (resume > 0 and state["mode"] == "PROGRAMMING"
+                   and state["expected_sha256"] == params.get("expected_sha256")
+                   and state["expected_size"] == params.get("expected_size")
+                   and state["hash_in_order"] and state["next_offset"] == resume)
         state["mode"] = "PROGRAMMING"
-        TRACER.log("FLASH_STARTED", {"expected_size": params.get("expected_size")})
-        state["buffer"] = bytearray()
-        state["expected_size"] = params.get("expected_size")
+        TRACER.log("FLASH_STARTED", {"expected_size": params.get("expected_size"), "resume_offset": resume if resumed else 0})
+        if not resumed:
+            state["expected_size"] = params.get("expected_size") or 0
+            state["view"].release()
+            state["buffer"] = bytearray(state["expected_size"])
+            state["view"] = memoryview(state["buffer"])
+            state["hasher"] = hashlib.sha256()
+            state["hash_in_order"] = True
+            state["ahead"] = {}
+            state["next_offset"] = 0
         state["expected_sha256"] = params.get("expected_sha256")
         state["expected_signature"] = params.get("expected_signature")
-        return success()
+        # Negotiate the bulk transfer codec (binary if the gateway offers it)
+        state["codec"] = CODEC_BINARY if CODEC_BINARY in params.get("codecs", []) else CODEC_JSON
+        compression = "zlib" if "zlib" in params.get("compression", []) else None
+        # Flow control: grant at most our window, at least our separation time
+        state["bs"] = max(1, min(params.get("bs", 1), FC_MAX_BLOCK_SIZE))
+        st_min_ms = max(params.get("st_min_ms", 0), FC_MIN_ST_MS)
+        state["window_count"] = 0
+        return success(codec=state["codec"], bs=state["bs"], st_min_ms=st_min_ms, compression=compression,
+                       resume_offset=state["next_offset"])
+
+    elif method == "get_progress":
+        # Highest contiguous offset held for the image being programmed, so an
+        # interrupted transfer can resume; the hash lets the gateway check the prefix
+        prefix_sha256 = state["hasher"].hexdigest() if state["hasher"] and state["hash_in_order"] else None
+        return success(mode=state["mode"], offset=state["next_offset"], sha256=prefix_sha256,
+                       expected_sha256=state["expected_sha256"])
         
-    elif method == "write_block":
+    elif method == "block_hashes":
+        # Truncated per-block hashes of the active slot, so the gateway only sends what changed
+        image = images[slots["current"]] or b""
+        size = params.get("block_size", 512)
+        digests = b"".join(hashlib.sha256(image[i:i+size]).digest()[:BLOCK_DIGEST_BYTES]
+                           for i in range(0, len(image), size))
+        return success(size=len(image), block_size=size, digest_bytes=BLOCK_DIGEST_BYTES,
+                       digests_b64=base64.b64encode(digests).decode())
+
+    elif method in ("write_block", "copy_range"):
         if state["mode"] != "PROGRAMMING":
             return fail("bad state")
         
         offset = params.get("offset")
-        block = base64.b64decode(params.get("block_b64"))
+        if method == "copy_range":
+            # Unchanged range: take it from the active slot at the same offset
+            block = (images[slots["current"]] or b"")[offset:offset + params.get("length", 0)]
+            if len(block) != params.get("length"):
+                return fail(f"copy at {offset} exceeds active slot image")
+        else:
+            try:
+                block = read_block(params)
+            except zlib.error as e:
+                return fail(f"bad compressed block at {offset}: {e}")
         
-        # Simple buffer management (extend or overwrite)
-        # In this sim, we just append assuming order, or use offset
-        if len(state["buffer"]) < offset:
-            state["buffer"].extend(b'\x00' * (offset - len(state["buffer"])))
-        state["buffer"][offset:offset+len(block)] = block
-        return success()
+        if offset + len(block) <= state["next_offset"]:
+            # Resent block we already hold: the gateway lost our ack, answer right away
+            state["window_count"] = 0
+            return success(offset=state["next_offset"])
+
+        if offset < 0 or offset + len(block) > state["expected_size"]:
+            return fail(f"block at {offset} exceeds image size")
+        store_block(offset, block)
+
+        # Only the last block of a window (or of the image) gets an ack
+        state["window_count"] += 1
+        if state["window_count"] < state["bs"] and offset + len(block) < state["expected_size"]:
+            return None
+        state["window_count"] = 0
+        return success(offset=state["next_offset"])
         
     elif method == "verify":
+        if state["mode"] == "VERIFIED":
+            return success() # Repeated call, the gateway lost our answer
         if state["mode"] != "PROGRAMMING":
             return fail("bad state")
             
         # 1. Check SHA256 of firmware
-        h = hashlib.sha256(state["buffer"]).hexdigest()
+        # In-order writes were hashed as they arrived; only fall back to a full pass otherwise
+        if state["hash_in_order"] and state["next_offset"] == state["expected_size"]:
+            h = state["hasher"].hexdigest()
+        else:
+            print("Out-of-order writes, hashing the full image")
+            h = hashlib.sha256(state["view"]).hexdigest()
         if h != state["expected_sha256"]:
             state["mode"] = "IDLE"
             return fail("sha mismatch")
@@ -93,10 +214,13 @@ def handle_rpc(method, params):
             return fail(f"signature invalid: {e}")
             
         state["mode"] = "VERIFIED"
+        images[slots["target"]] = bytes(state["buffer"])
         return success()
         
     elif method == "activate":
         simulate_failure = params.get("simulate_failure", False)
+        if state["mode"] == "ACTIVATED":
+            return success() # Repeated call, don't swap back
         if state["mode"] != "VERIFIED":
             return fail("bad state")
             
@@ -110,7 +234,21 @@ def handle_rpc(method, params):
         TRACER.log("FLASH_COMPLETED", {"status": "success"})
         return success()
         
+    elif method == "rollback":
+        # Gateway-driven rollback, e.g. another ECU in the same install group failed.
+        # A confirmed ECU still counts: its group as a whole was not committed.
+        if state["mode"] == "ROLLED_BACK":
+            return success() # Repeated call, don't swap back again
+        if state["mode"] not in ("ACTIVATED", "CONFIRMED"):
+            return fail("bad state")
+        slots["current"], slots["target"] = slots["target"], slots["current"]
+        state["mode"] = "ROLLED_BACK"
+        TRACER.log("FLASH_ROLLED_BACK", {"slot": slots["current"]})
+        return success()
+
     elif method == "confirm":
+        if state["mode"] == "CONFIRMED":
+            return success()
         if state["mode"] != "ACTIVATED":
             return fail("bad state")
         state["mode"] = "CONFIRMED"
@@ -123,4 +261,7 @@ while True:
     req = can_rpc.receive(LISTEN_ID)
     if req:
         resp = handle_rpc(req.get("m"), req.get("p"))
-        can_rpc.send(REPLY_ID, "response", resp)
+        if resp is None:
+            continue # Mid-window block, acked with the rest of the window
+        # Answer in the codec the request came in
+        can_rpc.send(REPLY_ID, "response", resp, codec=req.get("codec", CODEC_JSON))
@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+# Patches and reconstructed images, stored under their SHA-256 so a retried or
+# re-issued campaign finds them again. Least recently used entries are evicted
+# once the cache grows past CACHE_MAX_BYTES; entries in use by a campaign are
+# pinned and never evicted. The default fits a few multi-hundred-MB images.
+CACHE_DIR = os.getenv("OTA_CACHE_DIR", "/tmp/ota_cache")
+CACHE_MAX_BYTES = int(os.getenv("OTA_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+class ArtifactTooLarge(Exception):
+    """An artifact that doesn't fit in the cache even when it is empty."""
+
+class ArtifactCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pins = {} # sha256 -> number of users; pinned entries are never evicted
+        self.alias_path = os.path.join(root, "aliases.json")
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(self.alias_path, 'r') as f:
+                self.aliases = json.load(f)
+        except (OSError, ValueError):
+            self.aliases = {}
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256)
+
+    def get(self, sha256):
+        """
+        Returns the cached bytes for sha256, or None. The content is re-hashed
+        on every hit and a corrupted entry is dropped.
+        """
+        path = self.path(sha256)
+        try:
+            with open(path, 'rb') as f:
+                data = bytearray(os.fstat(f.fileno()).st_size)
+                f.readinto(data)
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != sha256:
+            logging.error(f"Cache entry {sha256} is corrupted, dropping it")
+            self.discard(path)
+            return None
+        os.utime(path) # Most recently used
+        return data
+
+    def check(self, sha256):
+        """
+        Like get, but re-hashes the entry in chunks and returns its path
+        instead of loading it.
+        """
+        path = self.path(sha256)
+        hasher = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+        except OSError:
+            return None
+        if hasher.hexdigest() != sha256:
+            logging.error(f"Cache entry {sha256} is corrupted, dropping it")
+            self.discard(path)
+            return None
+        os.utime(path) # Most recently used
+        return path
+
+    def put(self, data, sha256=None):
+        """
+        Stores data under its SHA-256 (computed if not given) and returns it.
+        """
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        tmp_path = self.path(sha256) + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self.adopt(tmp_path, sha256)
+
+    def adopt(self, file_path, sha256):
+        """
+        Moves an already verified file into the cache without copying it.
+        Room is made by evicting other entries, never the new one. A file
+        larger than max_bytes is deleted and refused with ArtifactTooLarge.
+        """
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            os.remove(file_path)
+            raise ArtifactTooLarge(f"Artifact {sha256} ({size} bytes) exceeds the cache limit of {self.max_bytes} bytes")
+        os.replace(file_path, self.path(sha256))
+        self.evict(keep=sha256)
+        return sha256
+
+    def pin(self, sha256):
+        """
+        Protects an entry (present or still to come) from eviction until unpinned.
+        """
+        with self.lock:
+            self.pins[sha256] = self.pins.get(sha256, 0) + 1
+
+    def unpin(self, sha256):
+        with self.lock:
+            users = self.pins.get(sha256, 0) - 1
+            if users > 0:
+                self.pins[sha256] = users
+            else:
+                self.pins.pop(sha256, None)
+        # Pinned entries may have held the cache over its limit
+        self.evict()
+
+    def alias(self, key, sha256):
+        """
+        Remembers the content hash behind a key, e.g. the URL of a patch whose
+        hash the manifest doesn't carry.
+        """
+        with self.lock:
+            self.aliases[key] = sha256
+            self.save_aliases()
+
+    def lookup(self, key):
+        return self.aliases.get(key)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits max_bytes.
+        keep and pinned entries stay, even if the cache remains over the limit.
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.root):
+                if len(name) != 64:
+                    continue # aliases.json, .tmp files
+                st = os.stat(self.path(name))
+                entries.append((st.st_mtime, st.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if name == keep or name in self.pins:
+                    continue
+                logging.info(f"Evicting {name} from artifact cache")
+                self.discard(self.path(name))
+                total -= size
+            # Forget aliases of evicted content
+            live = {name for _, _, name in entries if os.path.exists(self.path(name))}
+            self.aliases = {k: v for k, v in self.aliases.items() if v in live}
+            self.save_aliases()
+
+    def save_aliases(self):
+        tmp_path = self.alias_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.aliases, f)
+        os.replace(tmp_path, self.alias_path)
+
+    def discard(self, path):
+        if os.path.exists(path):
+            os.remove(path)
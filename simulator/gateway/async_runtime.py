@@ -0,0 +1,121 @@
+import asyncio
+import logging
+
+from control_plane_client import AsyncControlPlaneClient
+
+class AsyncAgentRuntime:
+    """
+    Drives an OTAAgent from a single asyncio event loop instead of its
+    worker thread (OTA_ASYNC_RUNTIME=1).
+
+    The state machine, transition table and timeouts stay in OTAAgent; this
+    runs each state's handler as a task. Control plane calls go through
+    grpc.aio, targets are fetched as one task each, and an emergency stop
+    cancels the running task instead of waiting for it to return. Transfers
+    already running in worker threads (HTTP, CAN) are told to stop and do so
+    at their next chunk or window.
+    """
+    def __init__(self, agent):
+        self.agent = agent
+        self.loop = asyncio.new_event_loop()
+        self.event = asyncio.Event()
+        self.phase = None # Task running the current state's handler
+        self.cp = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+
+    # Thread-safe entry points, called from MQTT, Flask and worker threads
+
+    def wake(self):
+        self.call(self.event.set)
+
+    def cancel_phase(self):
+        self.call(self.cancel_current)
+
+    def call(self, fn, *args):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def cancel_current(self):
+        if self.phase and not self.phase.done():
+            self.phase.cancel()
+
+    async def main(self):
+        agent = self.agent
+        self.cp = AsyncControlPlaneClient(agent.vehicle_id)
+        # Act on the state loaded from disk right away
+        self.event.set()
+        while agent.running:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout=agent.next_wakeup())
+            except asyncio.TimeoutError:
+                pass
+            self.event.clear()
+            if not agent.running:
+                break
+            state, handler = agent.due_handler()
+            if not handler:
+                continue
+            self.phase = asyncio.create_task(self.run_phase(handler))
+            try:
+                await self.phase
+            except asyncio.CancelledError:
+                logging.warning(f"Cancelled {state} work on Emergency Stop")
+            except Exception as e:
+                logging.error(f"Error in Agent Loop: {e}")
+                agent.schedule_retry(state)
+            self.phase = None
+
+        await self.cp.close()
+
+    async def run_phase(self, handler):
+        # Handlers without an async version run in a worker thread
+        native = getattr(self, handler, None)
+        if native:
+            await native()
+        else:
+            await asyncio.to_thread(getattr(self.agent, handler))
+
+    async def handle_notified(self):
+        try:
+            job_id = await self.cp.create_or_resume_job(self.agent.campaign_candidate)
+        except Exception as e:
+            logging.error(f"Failed to create job: {e}")
+            self.agent.set_state("IDLE")
+            return
+        self.agent.accept_job(job_id)
+
+    async def handle_confirming(self):
+        try:
+            data = await self.cp.get_manifest(self.agent.manifest_ref())
+            self.agent.accept_manifest(data)
+        except Exception as e:
+            logging.error(f"Failed to get/verify manifest: {e}")
+            self.agent.set_state("FAILED")
+
+    async def handle_downloading(self):
+        agent = self.agent
+        targets, workers, on_progress, cancel = agent.begin_downloads()
+        slots = asyncio.Semaphore(workers)
+
+        async def fetch(target):
+            async with slots:
+                if cancel.is_set():
+                    return None # Queued behind a target that failed or was stopped
+                return await asyncio.to_thread(agent.fetch_target, target, on_progress, cancel)
+
+        # Shielded so a cancel or a failure doesn't abandon threads still writing
+        # the .part files a retried phase would reuse
+        tasks = [asyncio.create_task(fetch(t)) for t in targets]
+        try:
+            results = await asyncio.shield(asyncio.gather(*tasks))
+        except BaseException:
+            cancel.set() # Running transfers stop at their next chunk
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        agent.finish_downloads([e for e in results if e])
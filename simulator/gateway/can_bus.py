@@ -1,89 +1,464 @@
 import can
+import os
 import json
+import struct
 import time
 import math
+import queue
+import threading
 
 # Virtual CAN via UDP Multicast
 # This allows containers to talk without a host network interface
 BUS_CONFIG = {"interface": "udp_multicast", "channel": "239.0.0.1", "bitrate": 500000}
 
+# Transport Mode
+# "classic": 8-byte frames, [SeqNum] [Flags] [Data (6B)...], DLC gives the length
+# "fd":      CAN FD frames up to 64 bytes, [SeqNum] [Flags] [Length] [Data (61B)...]
+# FD frames can only be 0-8, 12, 16, ... 64 bytes long, so they are padded and
+# carry the data length explicitly. All nodes on the bus must use the same mode.
+CAN_MODE = os.getenv("CAN_MODE", "classic")
+if CAN_MODE == "fd":
+    BUS_CONFIG.update({"fd": True, "data_bitrate": 2000000})
+
+FRAME_LAYOUTS = {
+    "classic": {"frame_size": 8,  "header_size": 2},
+    "fd":      {"frame_size": 64, "header_size": 3}
+}
+FD_FRAME_SIZES = [0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64]
+
+# Frame Flags
+FLAG_MORE = 0x01  # More frames follow in this payload
+FLAG_START = 0x02 # First frame of a payload
+FLAG_NACK = 0x80  # Control frame from a receiver, Data lists missing SeqNums
+
+# Selective Retransmission
+# SeqNums run continuously per arbitration ID (0..255, wrapping), so a lost
+# frame shows up as a gap even across payload boundaries. The receiver NACKs
+# the missing SeqNums on the same ID and the sender replays them from a short
+# history, instead of the whole payload timing out.
+RETRANSMIT_CONFIG = {
+    "history": 128,          # Frames per ID kept for replay (must stay below 256)
+    "nack_interval_s": 0.02, # Silence before (re)NACKing a gap or a stalled tail
+    "nack_retries": 5        # NACKs per gap before the broken payload is dropped
+}
+
+# Frame Pacing
+# Frames leave through a token bucket refilled at a share of the bus bitrate,
+# so throughput tracks the bus budget rather than a fixed per-frame sleep.
+PACING_CONFIG = {
+    "bus_load": float(os.getenv("CAN_BUS_LOAD", "0.8")),       # Share of the bitrate we may use
+    "burst_frames": int(os.getenv("CAN_BURST_FRAMES", "16")),  # Full-size frames sent back to back
+    "adaptive": os.getenv("CAN_ADAPTIVE_PACING", "1") == "1",  # Halve the rate on loss, creep back up
+    "recovery_s": 1.0                                           # Time to climb back to full rate
+}
+
+# Payload Codecs
+# JSON is the default and works for every method. The binary codec is
+# negotiated per ECU in enter_programming and only covers the bulk path
+# (write_block, plain or compressed, and its response), where the
+# JSON+base64 overhead hurts most.
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+
+# Method IDs borrowed from the UDS services they stand in for.
+# They never collide with '{' (0x7B), which is how JSON payloads start.
+METHOD_IDS = {
+    "write_block": 0x36, # TransferData
+    "response":    0x76  # Positive response to TransferData
+}
+METHOD_NAMES = {v: k for k, v in METHOD_IDS.items()}
+# write_block carrying a zlib-compressed block (TransferData with the top bit set)
+COMPRESSED_BLOCK_ID = 0xB6
+
+# write_block: [0x36] [Offset (4B)] [Length (2B)] [Data...]
+# compressed:  [0xB6] [Offset (4B)] [Uncompressed Length (2B)] [zlib Data...]
+WRITE_BLOCK_HEADER = struct.Struct(">BIH")
+# response:    [0x76] [Ok (1B)] [Offset (4B)] [Error (UTF-8)...]
+RESPONSE_HEADER = struct.Struct(">BBI")
+
+def frame_bits(data_len, fd=False):
+    """
+    Approximate on-wire length of one frame in nominal bit times, including
+    worst-case bit stuffing. FD data phase bits are scaled by the faster data bitrate.
+    """
+    if not fd:
+        return int((47 + 8 * data_len) * 1.2)
+    data_phase = (8 * data_len + 28) * BUS_CONFIG["bitrate"] / BUS_CONFIG["data_bitrate"]
+    return int((38 + data_phase) * 1.2)
+
+class TokenBucket:
+    """
+    Paces sends to a bit budget. Tokens are bit times, refilled at `rate` bits/s
+    up to `burst` bits. In adaptive mode the rate is halved on reported loss (at
+    most once per backoff_holdoff_s) and climbs back linearly over recovery_s.
+    """
+    def __init__(self, rate, burst, adaptive=False, recovery_s=1.0):
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.recovery_s = recovery_s
+        self.backoff_holdoff_s = recovery_s / 10
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.last_backoff = 0.0
+        self.lock = threading.Lock()
+
+    def consume(self, bits):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last
+            if self.adaptive and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * elapsed / self.recovery_s)
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last = now
+            self.tokens -= bits
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def backoff(self):
+        if not self.adaptive:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_backoff < self.backoff_holdoff_s:
+                return # One loss burst, one decrease
+            self.last_backoff = now
+            self.rate = max(self.min_rate, self.rate / 2)
+
+def encode_payload(method, params, codec=CODEC_JSON):
+    """
+    Serializes an RPC call. Falls back to JSON for methods without a binary layout.
+    """
+    if codec == CODEC_BINARY and method == "write_block" and "block_z" in params:
+        return WRITE_BLOCK_HEADER.pack(COMPRESSED_BLOCK_ID, params["offset"], params["length"]) + bytes(params["block_z"])
+    if codec == CODEC_BINARY and method == "write_block":
+        block = params["block"]
+        return WRITE_BLOCK_HEADER.pack(METHOD_IDS[method], params["offset"], len(block)) + bytes(block)
+    if codec == CODEC_BINARY and method == "response":
+        header = RESPONSE_HEADER.pack(METHOD_IDS[method], 1 if params.get("ok") else 0, params.get("offset", 0))
+        return header + params.get("error", "").encode('utf-8')
+    return json.dumps({"m": method, "p": params}).encode('utf-8')
+
+def decode_payload(payload):
+    """
+    Inverse of encode_payload. Returns {"m": method, "p": params, "codec": codec}.
+    """
+    if payload[:1] == b'{':
+        req = json.loads(payload.decode('utf-8'))
+        req["codec"] = CODEC_JSON
+        return req
+
+    if payload[0] == COMPRESSED_BLOCK_ID:
+        _, offset, length = WRITE_BLOCK_HEADER.unpack_from(payload)
+        params = {"offset": offset, "length": length, "block_z": bytes(payload[WRITE_BLOCK_HEADER.size:])}
+        return {"m": "write_block", "p": params, "codec": CODEC_BINARY}
+
+    method = METHOD_NAMES.get(payload[0])
+    if method == "write_block":
+        _, offset, length = WRITE_BLOCK_HEADER.unpack_from(payload)
+        block = bytes(payload[WRITE_BLOCK_HEADER.size:])
+        if len(block) != length:
+            raise ValueError(f"write_block length mismatch ({len(block)} != {length})")
+        return {"m": method, "p": {"offset": offset, "block": block}, "codec": CODEC_BINARY}
+    if method == "response":
+        _, ok, offset = RESPONSE_HEADER.unpack_from(payload)
+        params = {"ok": bool(ok), "offset": offset}
+        error = payload[RESPONSE_HEADER.size:]
+        if error:
+            params["error"] = error.decode('utf-8')
+        return {"m": method, "p": params, "codec": CODEC_BINARY}
+    raise ValueError(f"Unknown method ID {payload[0]:#x}")
+
 class CanRPC:
     def __init__(self, my_id):
         self.bus = can.Bus(**BUS_CONFIG)
         self.my_id = my_id # ID to listen for (simplified)
+        self.fd = (CAN_MODE == "fd")
+        layout = FRAME_LAYOUTS[CAN_MODE]
+        self.chunk_size = layout["frame_size"] - layout["header_size"]
+        self.pacer = TokenBucket(
+            BUS_CONFIG["bitrate"] * PACING_CONFIG["bus_load"],
+            frame_bits(layout["frame_size"], self.fd) * PACING_CONFIG["burst_frames"],
+            adaptive=PACING_CONFIG["adaptive"],
+            recovery_s=PACING_CONFIG["recovery_s"]
+        )
+        self._send_lock = threading.Lock()
+        self._tx_seq = {}     # arbitration_id -> next SeqNum to send
+        self._tx_history = {} # arbitration_id -> {SeqNum: can.Message} for replay
+
+        # Receive Demultiplexer
+        # A single reader thread owns bus.recv() and reassembles frames per
+        # arbitration ID, so concurrent conversations never steal each other's frames.
+        self._queues = {}   # arbitration_id -> queue.Queue of decoded payloads
+        self._partials = {} # arbitration_id -> receive state, see _rx_state()
+        self._queues_lock = threading.Lock()
+        self.subscribe(my_id)
 
-    def send(self, target_id, method, params):
+        self.stats = {
+            "frames_sent": 0,
+            "frames_received": 0,
+            "frames_dropped": 0,       # Gaps detected on receive
+            "frames_retransmitted": 0, # Frames replayed for a peer's NACK
+            "nacks_sent": 0,
+            "nacks_received": 0,
+            "payloads_dropped": 0      # Gaps that could not be repaired
+        }
+
+        self._running = True
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def subscribe(self, *arbitration_ids):
+        """
+        Starts queueing payloads for the given IDs. Frames for IDs nobody
+        subscribed to are dropped by the reader.
+        """
+        with self._queues_lock:
+            for arbitration_id in arbitration_ids:
+                self._queues.setdefault(arbitration_id, queue.Queue())
+
+    def send(self, target_id, method, params, codec=CODEC_JSON):
         """
         Sends an RPC call as a sequence of CAN frames (Simulated ISO-TP).
-        Format:
-        Frame 0: [0xAA] [TotalFrames] [MethodLen] [Method...]
-        Frame N: [0xBB] [SeqNum] [Data...]
-        """
-        payload = json.dumps({"m": method, "p": params}).encode('utf-8')
-        
-        # Split into chunks of 6 bytes (2 bytes header overhead)
-        # Real CAN is 8 bytes.
-        CHUNK_SIZE = 6
-        total_chunks = math.ceil(len(payload) / CHUNK_SIZE)
-        
-        # 1. Send Start Frame
-        # Header: [0xAA] [TotalChunks (1B)]
-        # We assume TotalChunks < 255 for simulation simplicity
-        # If payload is huge, this simple protocol breaks, but sufficient for our chunks
-        
-        # Actually, let's just use "Jumbo Frames" concept for simulation speed?
-        # python-can udp_multicast supports larger sizes? 
-        # Let's stick to strict 8-byte frames to prove the point of "CAN Bus".
-        
-        for i in range(total_chunks):
-            chunk = payload[i*CHUNK_SIZE : (i+1)*CHUNK_SIZE]
-            # Frame: [SeqNum] [MoreFlag] [Data...]
-            # SeqNum: 0..255
-            # MoreFlag: 1=More, 0=Last
-            is_last = (i == total_chunks - 1)
-            header = bytes([i % 255, 0 if is_last else 1])
-            data = header + chunk
-            
-            # Pad to 8 bytes
-            data = data.ljust(8, b'\x00')
-            
-            msg = can.Message(arbitration_id=target_id, data=data, is_extended_id=False)
-            self.bus.send(msg)
-            time.sleep(0.001) # Small delay to prevent UDP packet loss in Docker
+        Format (see FRAME_LAYOUTS):
+        Frame N: [SeqNum] [Flags] ([Length]) [Data...]
+        Classic frames are not padded, so the DLC carries the data length and
+        raw binary payloads may safely end in 0x00.
+        """
+        payload = encode_payload(method, params, codec)
+        total_chunks = math.ceil(len(payload) / self.chunk_size)
+
+        # One message at a time per bus, so concurrent senders don't interleave frames
+        with self._send_lock:
+            history = self._tx_history.setdefault(target_id, {})
+            for i in range(total_chunks):
+                chunk = payload[i*self.chunk_size : (i+1)*self.chunk_size]
+                flags = (FLAG_START if i == 0 else 0) | (FLAG_MORE if i < total_chunks - 1 else 0)
+                seq = self._tx_seq.get(target_id, 0)
+                self._tx_seq[target_id] = (seq + 1) % 256
+
+                msg = self._frame(target_id, seq, flags, chunk)
+                history[seq] = msg
+                self.pacer.consume(frame_bits(len(msg.data), self.fd))
+                self.bus.send(msg)
+                self.stats["frames_sent"] += 1
+
+    def report_loss(self):
+        """
+        Tells the pacer a frame or reply went missing so it can back off.
+        """
+        self.pacer.backoff()
+
+    def _frame(self, target_id, seq, flags, chunk):
+        if not self.fd:
+            return can.Message(arbitration_id=target_id, data=bytes([seq, flags]) + chunk, is_extended_id=False)
+        data = bytes([seq, flags, len(chunk)]) + chunk
+        size = next(n for n in FD_FRAME_SIZES if n >= len(data))
+        return can.Message(arbitration_id=target_id, data=data.ljust(size, b'\x00'),
+                           is_extended_id=False, is_fd=True, bitrate_switch=True)
+
+    def _unframe(self, msg):
+        """
+        Returns (SeqNum, Flags, Data) of a frame in either layout.
+        """
+        if msg.is_fd:
+            return msg.data[0], msg.data[1], bytes(msg.data[3:3 + msg.data[2]])
+        return msg.data[0], msg.data[1], bytes(msg.data[2:msg.dlc])
 
     def receive(self, expected_id, timeout=None):
         """
-        Blocks until a full JSON payload with arbitration_id == expected_id is received.
-        """
-        buffer = bytearray()
-        started = False
-        
-        start_time = time.time()
-        
-        while True:
-            # Check timeout
-            if timeout and (time.time() - start_time > timeout):
-                return None
-                
-            msg = self.bus.recv(0.1)
-            if not msg: continue
-            
-            if msg.arbitration_id != expected_id:
+        Blocks until a full RPC payload with arbitration_id == expected_id is received.
+        """
+        self.subscribe(expected_id)
+        try:
+            return self._queues[expected_id].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _read_loop(self):
+        while self._running:
+            msg = self.bus.recv(RETRANSMIT_CONFIG["nack_interval_s"])
+            if msg:
+                self._on_frame(msg)
+            self._check_stalls()
+
+    def _on_frame(self, msg):
+        seq, flags, chunk = self._unframe(msg)
+        if flags & FLAG_NACK:
+            self._handle_nack(msg.arbitration_id, chunk)
+            return
+
+        if msg.arbitration_id not in self._queues:
+            return
+        self.stats["frames_received"] += 1
+        self._deliver(msg.arbitration_id, self._reassemble(msg.arbitration_id, seq, flags, chunk))
+
+    def _deliver(self, arbitration_id, payloads):
+        for payload in payloads:
+            try:
+                self._queues[arbitration_id].put(decode_payload(payload))
+            except Exception:
+                self.stats["payloads_dropped"] += 1 # Corrupt payload, the caller's timeout handles it
+
+    def _rx_state(self, arbitration_id):
+        return self._partials.setdefault(arbitration_id, {
+            "expected": None, # Next in-order SeqNum (None until a payload start is seen)
+            "buffer": None,   # Payload being reassembled
+            "pending": {},    # Out-of-order frames waiting for a gap to fill, SeqNum -> (Flags, Data)
+            "nacked": {},     # SeqNum -> time, to recognize replays we asked for twice
+            "nacks": 0,       # NACKs sent for the current gap
+            "nack_at": 0.0,
+            "last_rx": 0.0
+        })
+
+    def _reassemble(self, arbitration_id, seq, flags, chunk):
+        """
+        Feeds one frame into the receive state of its arbitration ID.
+        Returns the list of payloads it completed (usually empty).
+        """
+        rx = self._rx_state(arbitration_id)
+        now = time.monotonic()
+        rx["last_rx"] = now
+
+        if rx["expected"] is None:
+            if not flags & FLAG_START:
+                return [] # Wait for a payload start to sync on
+            rx["expected"] = seq
+
+        distance = (seq - rx["expected"]) % 256
+        if distance >= 128:
+            # Behind us: either a replay we already have, or the peer restarted its SeqNums
+            if seq in rx["nacked"] or not flags & FLAG_START:
+                return []
+            rx.update({"expected": seq, "buffer": None, "pending": {}, "nacks": 0})
+            distance = 0
+
+        if distance > 0:
+            # Gap: park the frame and ask for what is missing
+            rx["pending"][seq] = (flags, chunk)
+            missing = self._missing(rx)
+            new = [s for s in missing if s not in rx["nacked"]]
+            if new:
+                self.stats["frames_dropped"] += len(new)
+                rx["nacks"] = 0 # A fresh loss gets the full retry budget
+                self._send_nack(arbitration_id, rx, missing)
+            return []
+
+        payloads = []
+        self._accept(rx, seq, flags, chunk, payloads)
+        while rx["expected"] in rx["pending"]:
+            seq = rx["expected"]
+            self._accept(rx, seq, *rx["pending"].pop(seq), payloads)
+        if not rx["pending"]:
+            rx["nacks"] = 0
+        return payloads
+
+    def _accept(self, rx, seq, flags, chunk, payloads):
+        rx["expected"] = (seq + 1) % 256
+        if flags & FLAG_START:
+            rx["buffer"] = bytearray()
+        elif rx["buffer"] is None:
+            return # Tail of a payload whose start we dropped
+        rx["buffer"].extend(chunk)
+        if not flags & FLAG_MORE:
+            payloads.append(bytes(rx["buffer"]))
+            rx["buffer"] = None
+
+    def _check_stalls(self):
+        """
+        Re-NACKs gaps that were not repaired and tails that went quiet, and gives
+        up on a gap after nack_retries by skipping to the next payload start.
+        """
+        now = time.monotonic()
+        interval = RETRANSMIT_CONFIG["nack_interval_s"]
+        for arbitration_id, rx in self._partials.items():
+            for seq, at in list(rx["nacked"].items()):
+                if now - at > 1.0:
+                    del rx["nacked"][seq]
+
+            if now - rx["nack_at"] < interval:
+                continue
+            if rx["pending"]:
+                if rx["nacks"] < RETRANSMIT_CONFIG["nack_retries"]:
+                    self._send_nack(arbitration_id, rx, self._missing(rx))
+                else:
+                    self._deliver(arbitration_id, self._skip_gap(rx))
+            elif rx["buffer"] is not None and now - rx["last_rx"] >= interval and rx["nacks"] < RETRANSMIT_CONFIG["nack_retries"]:
+                # Mid-payload silence: the tail frames may be lost with nothing behind them
+                self._send_nack(arbitration_id, rx, [rx["expected"]])
+
+    def _missing(self, rx):
+        """
+        SeqNums between the next expected frame and the furthest parked one.
+        """
+        span = max((s - rx["expected"]) % 256 for s in rx["pending"])
+        return [(rx["expected"] + i) % 256 for i in range(span) if (rx["expected"] + i) % 256 not in rx["pending"]]
+
+    def _skip_gap(self, rx):
+        """
+        Drops the payload broken by an unrepaired gap and resumes at the next
+        parked payload start. Returns any payloads completed from there.
+        """
+        self.stats["payloads_dropped"] += 1
+        rx["buffer"] = None
+        rx["nacks"] = 0
+        starts = sorted((s for s, (flags, _) in rx["pending"].items() if flags & FLAG_START),
+                        key=lambda s: (s - rx["expected"]) % 256)
+        if not starts:
+            rx.update({"expected": None, "pending": {}})
+            return []
+        skip = (starts[0] - rx["expected"]) % 256
+        for s in list(rx["pending"]):
+            if (s - rx["expected"]) % 256 < skip:
+                del rx["pending"][s]
+        rx["expected"] = starts[0]
+
+        payloads = []
+        while rx["expected"] in rx["pending"]:
+            seq = rx["expected"]
+            self._accept(rx, seq, *rx["pending"].pop(seq), payloads)
+        return payloads
+
+    def _send_nack(self, arbitration_id, rx, missing):
+        """
+        NACKs are sent on the data's own arbitration ID with FLAG_NACK set.
+        """
+        seqs = missing[:self.chunk_size]
+        now = time.monotonic()
+        rx["nack_at"] = now
+        rx["nacks"] += 1
+        for seq in seqs:
+            rx["nacked"][seq] = now
+        msg = self._frame(arbitration_id, 0, FLAG_NACK, bytes(seqs))
+        self.pacer.consume(frame_bits(len(msg.data), self.fd))
+        self.bus.send(msg)
+        self.stats["nacks_sent"] += 1
+
+    def _handle_nack(self, arbitration_id, seqs):
+        history = self._tx_history.get(arbitration_id)
+        if history is None:
+            return # Not a stream we send (e.g. our own NACK looped back)
+        # No pacer backoff here: isolated losses are cheap to repair, sustained
+        # loss surfaces as ack timeouts which callers pass to report_loss().
+        self.stats["nacks_received"] += 1
+
+        last = (self._tx_seq[arbitration_id] - 1) % 256
+        for seq in seqs:
+            # Only replay what was actually sent recently; anything else is
+            # either not sent yet (a tail probe) or already overwritten.
+            if (last - seq) % 256 >= RETRANSMIT_CONFIG["history"]:
                 continue
+            msg = history.get(seq)
+            if msg is None:
+                continue
+            self.pacer.consume(frame_bits(len(msg.data), self.fd))
+            self.bus.send(msg)
+            self.stats["frames_retransmitted"] += 1
 
-            # Process Frame
-            seq = msg.data[0]
-            more = msg.data[1]
-            chunk = msg.data[2:].rstrip(b'\x00') # Remove padding
-            
-            # Simple reassembly (naïve)
-            buffer.extend(chunk)
-            
-            if more == 0:
-                try:
-                    return json.loads(buffer.decode('utf-8'))
-                except:
-                    buffer = bytearray() # Reset on error
-                    
     def close(self):
+        self._running = False
+        self._reader.join()
         self.bus.shutdown()
@@ -38,16 +38,19 @@ class ControlPlaneClient:
             logging.error(f"GetManifest Failed: {e}")
             return None
 
+    def status_request(self, job_id, status, details=None):
+        # Convert details to JSON string if dict
+        d_str = json.dumps(details) if isinstance(details, dict) else str(details or "")
+        
+        return ota_pb2.UpdateJobStatusRequest(
+            job_id=job_id,
+            status=status,
+            details=d_str
+        )
+
     def report_status(self, job_id, status, details=None):
         try:
-            # Convert details to JSON string if dict
-            d_str = json.dumps(details) if isinstance(details, dict) else str(details or "")
-            
-            req = ota_pb2.UpdateJobStatusRequest(
-                job_id=job_id,
-                status=status,
-                details=d_str
-            )
+            req = self.status_request(job_id, status, details)
             self.stub.UpdateJobStatus(req)
             logging.info(f"Reported {status} for Job {job_id}")
             return True
@@ -55,6 +58,41 @@ class ControlPlaneClient:
             logging.error(f"ReportStatus Failed: {e}")
             return False
 
+    def report_status_batch(self, updates):
+        """
+        Sends [(job_id, status, details), ...] in one UpdateJobStatusBatch call.
+        Returns how many were applied: 0 on failure, None if the control plane
+        doesn't have the RPC.
+        """
+        try:
+            req = ota_pb2.UpdateJobStatusBatchRequest(updates=[self.status_request(*u) for u in updates])
+            resp = self.stub.UpdateJobStatusBatch(req)
+            logging.info(f"Reported {resp.received} status updates")
+            return resp.received
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                return None
+            logging.error(f"ReportStatusBatch Failed: {e}")
+            return 0
+
+    def stream_status(self, updates, on_ack):
+        """
+        Sends the (job_id, status, details) tuples from updates over one
+        StreamJobStatus call, kept open until updates ends. on_ack() is called
+        as each update is applied, in order. Returns True once the stream
+        closes cleanly, False if it broke, None if the control plane doesn't
+        have the RPC.
+        """
+        try:
+            for resp in self.stub.StreamJobStatus(self.status_request(*u) for u in updates):
+                on_ack()
+            return True
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                return None
+            logging.error(f"StreamJobStatus Failed: {e}")
+            return False
+
     def confirm_emergency_stop(self, request_id, status="STOPPED"):
         try:
             req = ota_pb2.ConfirmEmergencyStopRequest(
@@ -82,3 +120,47 @@ class ControlPlaneClient:
         except grpc.RpcError as e:
             logging.error(f"CreateJob Failed: {e}")
             raise
+
+class AsyncControlPlaneClient:
+    """
+    grpc.aio counterpart of ControlPlaneClient for the asyncio runtime.
+    Create it inside the event loop that uses it.
+    """
+    def __init__(self, vehicle_id):
+        self.vehicle_id = vehicle_id
+        self.channel = grpc.aio.insecure_channel(CONTROL_PLANE_TARGET)
+        self.stub = ota_pb2_grpc.OtaControlStub(self.channel)
+        logging.info(f"Connected to Control Plane at {CONTROL_PLANE_TARGET} (async)")
+
+    async def get_manifest(self, manifest_ref):
+        try:
+            req = ota_pb2.GetManifestRequest(manifest_ref=manifest_ref)
+            resp = await self.stub.GetManifest(req)
+
+            if resp.found:
+                return {
+                    "manifest": json.loads(resp.manifest_json),
+                    "signature": resp.signature
+                }
+            return None
+        except grpc.RpcError as e:
+            logging.error(f"GetManifest Failed: {e}")
+            return None
+
+    async def create_or_resume_job(self, campaign_id):
+        try:
+            req = ota_pb2.CreateJobRequest(
+                campaign_id=campaign_id,
+                vehicle_id=self.vehicle_id
+            )
+            resp = await self.stub.CreateJob(req)
+            if resp.created:
+                logging.info(f"Job Created: {resp.job_id}")
+                return resp.job_id
+            return None
+        except grpc.RpcError as e:
+            logging.error(f"CreateJob Failed: {e}")
+            raise
+
+    async def close(self):
+        await self.channel.close()
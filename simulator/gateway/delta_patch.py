@@ -0,0 +1,132 @@
+import os
+import bz2
+import mmap
+import hashlib
+
+# Streaming application of BSDIFF40 patches (the format bsdiff4 writes).
+# The base image is mapped rather than read, the three bz2 streams of the
+# patch are decompressed incrementally and the target image is written to a
+# file as it is produced, so memory stays around a few CHUNK_SIZE buffers
+# whatever the image size.
+MAGIC = b"BSDIFF40"
+HEADER_SIZE = 32
+CHUNK_SIZE = 64 * 1024
+READ_SIZE = 64 * 1024
+
+# Bytewise addition without carries between bytes, done on whole chunks as big ints
+_LOW7 = int.from_bytes(b"\x7f" * CHUNK_SIZE, "little")
+_HIGH = int.from_bytes(b"\x80" * CHUNK_SIZE, "little")
+
+def decode_int64(b):
+    """
+    bsdiff offset encoding: little-endian magnitude, sign in the top bit.
+    """
+    n = int.from_bytes(b, "little")
+    return -(n & ~(1 << 63)) if n & (1 << 63) else n
+
+def add_bytes(a, b):
+    """
+    (a[i] + b[i]) % 256 for two equally long byte strings.
+    """
+    n = len(a)
+    low7, high = (_LOW7, _HIGH) if n == CHUNK_SIZE else (
+        int.from_bytes(b"\x7f" * n, "little"), int.from_bytes(b"\x80" * n, "little"))
+    x = int.from_bytes(a, "little")
+    y = int.from_bytes(b, "little")
+    return (((x & low7) + (y & low7)) ^ ((x ^ y) & high)).to_bytes(n, "little")
+
+class Bz2Stream:
+    """
+    Reads exactly the requested number of bytes from one bz2 block of a
+    patch file, decompressing no more than needed.
+    """
+    def __init__(self, path, offset, length):
+        self.f = open(path, 'rb')
+        self.f.seek(offset)
+        self.remaining = length
+        self.d = bz2.BZ2Decompressor()
+
+    def read(self, n):
+        out = bytearray()
+        while len(out) < n:
+            if self.d.eof:
+                raise ValueError("corrupt patch: bz2 stream ended early")
+            data = b""
+            if self.d.needs_input:
+                data = self.f.read(min(READ_SIZE, self.remaining))
+                if not data:
+                    raise ValueError("corrupt patch: truncated")
+                self.remaining -= len(data)
+            out += self.d.decompress(data, n - len(out))
+        return out
+
+    def close(self):
+        self.f.close()
+
+def apply_patch_file(base_path, patch_path, out_path):
+    """
+    Applies a BSDIFF40 patch from patch_path to the image at base_path and
+    writes the result to out_path. Returns {"size", "sha256"} of the output.
+    """
+    with open(patch_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[:8] != MAGIC:
+        raise ValueError("incorrect magic bsdiff4 header")
+    len_control = decode_int64(header[8:16])
+    len_diff = decode_int64(header[16:24])
+    len_dst = decode_int64(header[24:32])
+    patch_size = os.path.getsize(patch_path)
+    if len_control < 0 or len_diff < 0 or len_dst < 0 or HEADER_SIZE + len_control + len_diff > patch_size:
+        raise ValueError("corrupt patch: bad header")
+
+    control = Bz2Stream(patch_path, HEADER_SIZE, len_control)
+    diff = Bz2Stream(patch_path, HEADER_SIZE + len_control, len_diff)
+    extra = Bz2Stream(patch_path, HEADER_SIZE + len_control + len_diff,
+                      patch_size - HEADER_SIZE - len_control - len_diff)
+    hasher = hashlib.sha256()
+    base_file = open(base_path, 'rb')
+    base_size = os.fstat(base_file.fileno()).st_size
+    base = mmap.mmap(base_file.fileno(), 0, access=mmap.ACCESS_READ) if base_size else b""
+    try:
+        with open(out_path, 'wb') as out:
+            oldpos = newpos = 0
+            while newpos < len_dst:
+                ctrl = control.read(24)
+                x, y, z = decode_int64(ctrl[0:8]), decode_int64(ctrl[8:16]), decode_int64(ctrl[16:24])
+                if x < 0 or y < 0 or newpos + x + y > len_dst:
+                    raise ValueError("corrupt patch: control out of range")
+
+                # x bytes: diff block added to the base at oldpos (0 outside the base)
+                while x:
+                    n = min(CHUNK_SIZE, x)
+                    lo, hi = max(oldpos, 0), min(oldpos + n, base_size)
+                    if lo >= hi:
+                        old = bytes(n)
+                    elif lo == oldpos and hi == oldpos + n:
+                        old = base[lo:hi]
+                    else:
+                        old = bytes(lo - oldpos) + base[lo:hi] + bytes(oldpos + n - hi)
+                    chunk = add_bytes(diff.read(n), old)
+                    out.write(chunk)
+                    hasher.update(chunk)
+                    oldpos += n
+                    newpos += n
+                    x -= n
+
+                # y bytes: copied from the extra block
+                while y:
+                    n = min(CHUNK_SIZE, y)
+                    chunk = extra.read(n)
+                    out.write(chunk)
+                    hasher.update(chunk)
+                    newpos += n
+                    y -= n
+
+                oldpos += z
+    finally:
+        if base_size:
+            base.close()
+        base_file.close()
+        for s in (control, diff, extra):
+            s.close()
+    return {"size": len_dst, "sha256": hasher.hexdigest()}
@@ -1,38 +1,432 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 import os
+import json
+import time
+import queue
 import logging
+import threading
+
+DOWNLOAD_ATTEMPTS = 3 # Each attempt resumes from what the previous one left behind
+DOWNLOAD_TIMEOUT = (5, 30) # Connect / read seconds
+
+# Connection pool shared by every download: kept-alive connections to the
+# artifact server, enough for segmented downloads of several targets at once.
+# Requests failing with a 5xx or a dropped connection are retried with
+# exponential backoff before the attempt counts as failed.
+POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", "16"))
+HTTP_RETRIES = int(os.getenv("DOWNLOAD_HTTP_RETRIES", "3"))
+HTTP_BACKOFF_S = float(os.getenv("DOWNLOAD_BACKOFF_S", "0.5"))
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Body reads grow from CHUNK_MIN while the link fills them quickly and shrink
+# when a read stalls, so fast links aren't throttled by per-chunk overhead.
+CHUNK_MIN = 16 * 1024
+CHUNK_MAX = 1024 * 1024
+CHUNK_FAST_S = 0.05
+CHUNK_SLOW_S = 0.5
+
+# Segmented mode: artifacts of at least SEGMENT_THRESHOLD bytes are fetched as
+# byte ranges by concurrent connections. It starts with INITIAL_CONNECTIONS and
+# opens another one every ADAPT_INTERVAL_S while that still raises throughput.
+SEGMENT_THRESHOLD = 8 * 1024 * 1024
+SEGMENT_SIZE = 1024 * 1024
+INITIAL_CONNECTIONS = 2
+MAX_CONNECTIONS = 8
+ADAPT_INTERVAL_S = 1.0
+ADAPT_MIN_GAIN = 1.1 # Keep adding connections while each one buys 10% more
 
 class ArtifactDownloader:
-    def download(self, url, target_path, expected_hash, expected_size):
+    def __init__(self, cache=None):
+        self.cache = cache # Optional ArtifactCache consulted before the network
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_BACKOFF_S,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=["GET", "HEAD"],
+            raise_on_status=False # Hand the last response back, raise_for_status reports it
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def download(self, url, target_path, expected_hash, expected_size, metrics=None, progress=None, cancel=None,
+                 cache_key=None, keep_in_memory=True):
+        """
+        Fetches url to target_path, resuming any earlier partial download.
+        The artifact is hashed as it arrives and kept in memory, so callers get
+        {"data": bytearray, "sha256": hex, "path": file} without reading the file
+        back; None on failure. With keep_in_memory=False "data" is None and only
+        the file holds the artifact. Per-segment metrics of a segmented download are appended to metrics.
+        progress(bytes_held) is called as data arrives; setting the cancel event
+        aborts the download. With a cache, finished downloads are moved into it
+        (target_path is then not written) and later calls are served from it;
+        without an expected_hash they are found by cache_key (default: the URL).
+        The returned artifact is pinned in the cache; release it with cache.unpin.
+        """
+        cache_key = cache_key or url
+        if self.cache:
+            sha = expected_hash or self.cache.lookup(cache_key)
+            if sha:
+                self.cache.pin(sha) # Before the check, so it can't be evicted in between
+                data = self.cache.get(sha) if keep_in_memory else None
+                if data is not None or (not keep_in_memory and self.cache.check(sha)):
+                    logging.info(f"Artifact {url} served from cache ({sha})")
+                    if progress:
+                        progress(os.path.getsize(self.cache.path(sha)))
+                    return {"data": data, "sha256": sha, "path": self.cache.path(sha)}
+                self.cache.unpin(sha)
+
         if os.path.exists(target_path):
             # Simple resume check: if size matches, assume good (in prod verify hash)
             if os.path.getsize(target_path) == expected_size:
                 logging.info(f"Artifact {target_path} already exists. Verifying...")
-                if self.verify_hash(target_path, expected_hash):
+                data = None
+                if keep_in_memory:
+                    data = bytearray(expected_size)
+                    with open(target_path, 'rb') as f:
+                        f.readinto(data)
+                    sha = hashlib.sha256(data).hexdigest()
+                else:
+                    sha = self.hash_file(target_path).hexdigest()
+                if self.hash_matches(sha, expected_hash, target_path):
+                    if progress:
+                        progress(expected_size)
+                    if self.cache:
+                        self.cache.pin(sha) # Same contract as the other returns
+                    return {"data": data, "sha256": sha, "path": target_path}
+
+        part_path = target_path + ".part"
+        body = self.new_body(keep_in_memory)
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            if cancel and cancel.is_set():
+                logging.info(f"Download of {url} cancelled")
+                return None
+            logging.info(f"Downloading {url} to {target_path} (attempt {attempt}/{DOWNLOAD_ATTEMPTS})...")
+            try:
+                if expected_size and expected_size >= SEGMENT_THRESHOLD:
+                    done = self.fetch_segmented(url, part_path, expected_size, body, metrics, progress, cancel)
+                    if done is not None:
+                        if done:
+                            break
+                        continue
+                if self.fetch(url, part_path, expected_size, body, progress, cancel):
+                    break
+            except Exception as e:
+                # The .part file stays; the next attempt asks only for the rest
+                logging.error(f"Download failed: {e}")
+        else:
+            return None
+
+        self.discard(part_path + ".meta")
+        sha = body["hasher"].hexdigest()
+        if not self.hash_matches(sha, expected_hash, part_path):
+            os.remove(part_path)
+            return None
+        if self.cache:
+            self.cache.pin(sha)
+            try:
+                self.cache.adopt(part_path, sha)
+            except Exception:
+                self.cache.unpin(sha)
+                raise
+            self.cache.alias(cache_key, sha)
+            path = self.cache.path(sha)
+        else:
+            os.replace(part_path, target_path)
+            path = target_path
+        return {"data": body["data"] if body["keep"] else None, "sha256": sha, "path": path}
+
+    def new_body(self, keep=True):
+        """
+        In-memory copy of an artifact being downloaded (unless keep is False),
+        with the SHA-256 of its first "hashed" bytes.
+        """
+        return {"data": bytearray(), "hasher": hashlib.sha256(), "hashed": 0, "keep": keep}
+
+    def hash_file(self, path, length=None):
+        """
+        Hasher fed with the first length bytes of a file (all of it by default), read in chunks.
+        """
+        hasher = hashlib.sha256()
+        remaining = os.path.getsize(path) if length is None else length
+        with open(path, 'rb') as f:
+            while remaining:
+                chunk = f.read(min(CHUNK_MAX, remaining))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        return hasher
+
+    def fetch(self, url, part_path, expected_size, body, progress=None, cancel=None):
+        """
+        Completes part_path from the server, resuming with a Range request when
+        a partial file of the same artifact exists. Every byte is also appended
+        to body and hashed. Returns True once the part holds the whole
+        artifact, False if it must be started over.
+        """
+        meta_path = part_path + ".meta"
+        meta = self.load_meta(meta_path)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # A segmented part is preallocated and may have holes, it can't be appended to
+        if offset and (meta.get("url") != url or "segments" in meta or (expected_size and offset > expected_size)):
+            logging.warning(f"Discarding stale partial download {part_path}")
+            offset = 0
+        if body["hashed"] != offset or (body["keep"] and len(body["data"]) != offset):
+            # Prefix left by an earlier run: read it back once
+            body.update(self.new_body(body["keep"]))
+            if offset and body["keep"]:
+                with open(part_path, 'rb') as f:
+                    body["data"] = bytearray(f.read(offset))
+                body["hasher"].update(body["data"])
+            elif offset:
+                body["hasher"] = self.hash_file(part_path, offset)
+            body["hashed"] = offset
+
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            # Only honour the range if the artifact is unchanged; otherwise the server sends it whole
+            validator = meta.get("etag") or meta.get("last_modified")
+            if validator:
+                headers["If-Range"] = validator
+
+        with self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            if r.status_code == 416:
+                # Nothing left to send: either we already have it all or the part is junk
+                if expected_size and offset == expected_size:
                     return True
-        
-        logging.info(f"Downloading {url} to {target_path}...")
+                self.discard(part_path)
+                self.discard(meta_path)
+                return False
+            r.raise_for_status()
+
+            if r.status_code == 206 and offset:
+                start = r.headers.get("Content-Range", "").split(" ")[-1].split("-")[0]
+                if start != str(offset):
+                    raise IOError(f"unexpected Content-Range {r.headers.get('Content-Range')}")
+                mode = 'ab'
+                logging.info(f"Resuming {url} at byte {offset}")
+            else:
+                # 200: ranges unsupported or the artifact changed, start from zero
+                offset = 0
+                mode = 'wb'
+                body.update(self.new_body(body["keep"]))
+
+            with open(meta_path, 'w') as f:
+                json.dump({
+                    "url": url,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified")
+                }, f)
+
+            with open(part_path, mode) as f:
+                for chunk in self.read_chunks(r, cancel):
+                    f.write(chunk)
+                    if body["keep"]:
+                        body["data"] += chunk
+                    body["hasher"].update(chunk)
+                    body["hashed"] += len(chunk)
+                    if progress:
+                        progress(body["hashed"])
+
+        size = os.path.getsize(part_path)
+        if expected_size and size != expected_size:
+            raise IOError(f"got {size} of {expected_size} bytes")
+        return True
+
+    def fetch_segmented(self, url, part_path, size, body, metrics, progress=None, cancel=None):
+        """
+        Fetches size bytes as SEGMENT_SIZE ranges over a growing number of
+        connections, each written in place into a preallocated part file and
+        into body. The hash advances whenever the contiguous prefix grows
+        (read back from the page cache when body isn't kept in memory).
+        Segments finished by an earlier attempt are skipped. Returns None if the
+        server doesn't support ranges, True once every segment is in.
+        """
+        meta_path = part_path + ".meta"
+        head = self.session.head(url, timeout=DOWNLOAD_TIMEOUT, allow_redirects=True)
+        head.raise_for_status()
+        if head.headers.get("Accept-Ranges") != "bytes":
+            logging.info(f"{url} doesn't accept ranges, downloading as one stream")
+            return None
+        validator = head.headers.get("ETag") or head.headers.get("Last-Modified")
+
+        meta = self.load_meta(meta_path)
+        done = set()
+        if (meta.get("url") == url and meta.get("validator") == validator and meta.get("segment_size") == SEGMENT_SIZE
+                and os.path.exists(part_path) and os.path.getsize(part_path) == size):
+            done = set(meta.get("segments", []))
+        if body.get("segments") != done or (body["keep"] and len(body["data"]) != size):
+            # Segments left by an earlier run: read them back once
+            body.update(self.new_body(body["keep"]))
+            if body["keep"]:
+                body["data"] = bytearray(size)
+                if done:
+                    with open(part_path, 'rb') as f:
+                        f.readinto(body["data"])
+        body["segments"] = done
+        view = memoryview(body["data"]) if body["keep"] else None
+
+        def advance_hash():
+            while body["hashed"] < size and body["hashed"] in done:
+                end = min(size, body["hashed"] + SEGMENT_SIZE)
+                if view is not None:
+                    body["hasher"].update(view[body["hashed"]:end])
+                else:
+                    body["hasher"].update(os.pread(fd, end - body["hashed"], body["hashed"]))
+                body["hashed"] = end
+
+        segments = range(0, size, SEGMENT_SIZE)
+        pending = queue.Queue()
+        for start in segments:
+            if start not in done:
+                pending.put((start, min(size, start + SEGMENT_SIZE)))
+        held_before = sum(min(size, start + SEGMENT_SIZE) - start for start in done)
+        if done:
+            logging.info(f"Resuming {url}: {len(done)} segments already downloaded")
+
+        lock = threading.Lock()
+        transfer = {"bytes": 0, "error": None, "connections": 0}
+        finished = threading.Event() # Set when the last connection runs out of work
+
+        def save_meta():
+            with open(meta_path, 'w') as f:
+                json.dump({"url": url, "validator": validator, "segment_size": SEGMENT_SIZE,
+                           "segments": sorted(done)}, f)
+
+        def worker(conn_id):
+            try:
+                fetch_segments(conn_id)
+            finally:
+                with lock:
+                    transfer["connections"] -= 1
+                    if transfer["connections"] == 0:
+                        finished.set()
+
+        def fetch_segments(conn_id):
+            while transfer["error"] is None:
+                try:
+                    start, end = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    started = time.time()
+                    headers = {"Range": f"bytes={start}-{end - 1}"}
+                    if validator:
+                        headers["If-Range"] = validator
+                    with self.session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise IOError(f"range {start}-{end - 1} answered with {r.status_code}")
+                        pos = start
+                        for chunk in self.read_chunks(r, cancel):
+                            os.pwrite(fd, chunk, pos)
+                            if view is not None:
+                                view[pos:pos + len(chunk)] = chunk
+                            pos += len(chunk)
+                            with lock:
+                                transfer["bytes"] += len(chunk)
+                                if progress:
+                                    progress(min(size, held_before + transfer["bytes"]))
+                    if pos != end:
+                        raise IOError(f"range {start}-{end - 1} ended at {pos}")
+                    elapsed = time.time() - started
+                    with lock:
+                        done.add(start)
+                        save_meta()
+                        advance_hash()
+                        if metrics is not None:
+                            metrics.append({
+                                "start": start,
+                                "bytes": end - start,
+                                "seconds": round(elapsed, 3),
+                                "bytes_per_s": round((end - start) / elapsed) if elapsed > 0 else 0,
+                                "connection": conn_id
+                            })
+                except Exception as e:
+                    transfer["error"] = e
+
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
         try:
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()
-                with open(target_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-            
-            return self.verify_hash(target_path, expected_hash)
-        except Exception as e:
-            logging.error(f"Download failed: {e}")
-            return False
+            os.ftruncate(fd, size)
+            with lock:
+                advance_hash()
+                save_meta()
+            threads = []
+            def open_connection():
+                with lock:
+                    transfer["connections"] += 1
+                t = threading.Thread(target=worker, args=(len(threads),), daemon=True)
+                threads.append(t)
+                t.start()
+            for _ in range(min(INITIAL_CONNECTIONS, pending.qsize())):
+                open_connection()
+            if not threads:
+                finished.set()
+
+            # Add connections while the measured rate keeps improving
+            best_rate = 0
+            last_bytes = 0
+            while not finished.wait(ADAPT_INTERVAL_S):
+                rate = (transfer["bytes"] - last_bytes) / ADAPT_INTERVAL_S
+                last_bytes = transfer["bytes"]
+                if rate > best_rate * ADAPT_MIN_GAIN and len(threads) < MAX_CONNECTIONS and not pending.empty():
+                    open_connection()
+                best_rate = max(best_rate, rate)
+            for t in threads:
+                t.join()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+            if view is not None:
+                view.release()
+
+        if transfer["error"] is not None:
+            raise transfer["error"]
+        logging.info(f"Downloaded {url} in {len(segments)} segments over {len(threads)} connections")
+        return len(done) == len(segments)
+
+    def read_chunks(self, r, cancel=None):
+        """
+        Yields the response body in chunks sized to the observed read speed.
+        """
+        size = CHUNK_MIN
+        while True:
+            if cancel and cancel.is_set():
+                raise IOError("download cancelled")
+            started = time.time()
+            chunk = r.raw.read(size, decode_content=True)
+            if not chunk:
+                return
+            elapsed = time.time() - started
+            if len(chunk) == size and elapsed < CHUNK_FAST_S:
+                size = min(size * 2, CHUNK_MAX)
+            elif elapsed > CHUNK_SLOW_S:
+                size = max(size // 2, CHUNK_MIN)
+            yield chunk
+
+    def load_meta(self, meta_path):
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def discard(self, path):
+        if os.path.exists(path):
+            os.remove(path)
 
-    def verify_hash(self, path, expected_hash):
+    def hash_matches(self, calc_hash, expected_hash, path):
         if expected_hash is None:
             return True
-        sha256 = hashlib.sha256()
-        with open(path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256.update(chunk)
-        calc_hash = sha256.hexdigest()
         if calc_hash == expected_hash:
             logging.info(f"Hash verified for {path}")
             return True
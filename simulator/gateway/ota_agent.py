@@ -1,11 +1,21 @@
 import os, time, json, logging, threading, base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import hashlib
+import zlib
+import mmap
+import tracemalloc
 import bsdiff4
 from cryptography.hazmat.primitives.asymmetric import ed25519
 
 from mqtt_client import OTAEventListener
 from control_plane_client import ControlPlaneClient
+from async_runtime import AsyncAgentRuntime
 from downloader import ArtifactDownloader
+from artifact_cache import ArtifactCache, ArtifactTooLarge
+from state_journal import StateJournal, DELETED
+from status_outbox import StatusOutbox
+from delta_patch import apply_patch_file, CHUNK_SIZE as PATCH_CHUNK_SIZE
+from can_bus import CODEC_JSON, CODEC_BINARY, CAN_MODE
 from trace_logger import TraceLogger
 
 TRACER = TraceLogger("gateway")
@@ -26,37 +36,128 @@ STATES = {
     "ROLLED_BACK": "ROLLED_BACK"
 }
 
+# Allowed transitions. Emergency stop is accepted from any state.
+TRANSITIONS = {
+    "IDLE": {"NOTIFIED"},
+    "NOTIFIED": {"CONFIRMING", "IDLE", "FAILED"},
+    "CONFIRMING": {"WAITING_FOR_APPROVAL", "FAILED"},
+    "WAITING_FOR_APPROVAL": {"DOWNLOADING", "FAILED"},
+    "DOWNLOADING": {"STAGED", "FAILED"},
+    "STAGED": {"INSTALLING", "FAILED"},
+    "INSTALLING": {"VALIDATING", "ROLLED_BACK", "FAILED"},
+    "VALIDATING": {"SUCCEEDED", "FAILED"},
+    "SUCCEEDED": {"NOTIFIED"},
+    "FAILED": {"NOTIFIED"},
+    "ROLLED_BACK": {"NOTIFIED"},
+    "STOPPED": {"IDLE", "NOTIFIED"} # A stopped gateway takes the next campaign
+}
+# Work the agent does on entering a state (run by the worker thread)
+STATE_HANDLERS = {
+    "NOTIFIED": "handle_notified",
+    "CONFIRMING": "handle_confirming",
+    "WAITING_FOR_APPROVAL": "handle_waiting_for_approval",
+    "DOWNLOADING": "handle_downloading",
+    "STAGED": "handle_installing" # Auto proceed to install for sim simplicity, or check local gates
+}
+# Seconds a state may last before the campaign fails. A handler that raises
+# is retried every HANDLER_RETRY_S until then.
+STATE_TIMEOUTS = {
+    "NOTIFIED": 60,
+    "CONFIRMING": 120,
+    "WAITING_FOR_APPROVAL": 24 * 3600,
+    "DOWNLOADING": 6 * 3600
+}
+HANDLER_RETRY_S = 1.0
+
 ECUS = ["engine", "adas"]
 CAN_IDS = {
     "engine": {"tx": 0x100, "rx": 0x101},
     "adas":   {"tx": 0x200, "rx": 0x201}
 }
 
+# ISO 15765-2 style flow control for flashing, tunable per ECU.
+# bs: write_block calls per acknowledged window (1 = stop-and-wait)
+# st_min_ms: separation time between blocks inside a window
+# The ECU answers enter_programming with the values it actually grants.
+FLOW_CONTROL = {
+    "engine": {"bs": 8, "st_min_ms": 0},
+    "adas":   {"bs": 8, "st_min_ms": 0}
+}
+BLOCK_SIZE = 512
+
+# Per-ECU write_block compression. Each block is compressed on its own with
+# zlib (so a resent block decodes standalone) and sent raw when it doesn't shrink.
+# FLASH_COMPRESSION trace events show whether it pays off for a target.
+COMPRESSION = {
+    "engine": True,
+    "adas":   True
+}
+ZLIB_LEVEL = 6
+# Skip blocks the ECU's active slot already holds (compared by truncated hash);
+# the ECU copies them locally instead of receiving them over CAN.
+DIFFERENTIAL_FLASH = True
+ACK_TIMEOUT = 1.0 # Per attempt, before probing for a lost window ack
+ACK_RETRIES = 3   # Attempts per window ack or ECU call
+FLASH_ATTEMPTS = 3 # Per ECU; later attempts resume from the last acked offset
+DOWNLOAD_WORKERS = 4 # Targets downloaded and patched at the same time
+# Pipelined mode: each ECU starts flashing its inactive slot as soon as its
+# artifact is verified, while the other targets are still downloading.
+# Nothing is activated before every target is staged.
+PIPELINE_INSTALL = os.getenv("OTA_PIPELINE_INSTALL", "0") == "1"
+# Streaming patch mode for memory-constrained gateways: patches stay on disk,
+# the base image is mapped and the target image is written to a file in the
+# artifact cache without ever being held in memory as a whole.
+STREAMING_PATCH = os.getenv("OTA_STREAMING_PATCH", "0") == "1"
+# Opt-in asyncio runtime: one event loop drives the state machine, talks to
+# the control plane over grpc.aio and runs the per-target work as tasks that
+# an emergency stop cancels right away (see async_runtime.py).
+ASYNC_RUNTIME = os.getenv("OTA_ASYNC_RUNTIME", "0") == "1"
+
 class OTAAgent:
     def __init__(self, vehicle_id, can_rpc):
         self.vehicle_id = vehicle_id
         self.can_rpc = can_rpc
+        # Queue ECU replies from the start so none are dropped between calls
+        self.can_rpc.subscribe(*[ids["rx"] for ids in CAN_IDS.values()])
         
         # Config
         self.cp_url = os.getenv("CONTROL_PLANE_URL", "http://control-plane:50051")
         self.broker = os.getenv("MQTT_BROKER", "mqtt")
         self.storage_path = "/tmp/ota_state.json"
+        self.journal = StateJournal(self.storage_path)
         
         # Clients
         self.cp_client = ControlPlaneClient(vehicle_id)
+        self.outbox = StatusOutbox(self.cp_client, self.journal)
         self.mqtt_listener = OTAEventListener(self.broker, vehicle_id, 
                                               on_notify=self.on_mqtt_notify,
                                               on_stop=self.on_mqtt_stop)
-        self.downloader = ArtifactDownloader()
+        self.cache = ArtifactCache()
+        self.downloader = ArtifactDownloader(self.cache)
         
         # State
         self.state = STATES["IDLE"]
         self.job_id = None
         self.campaign_id = None
         self.manifest = None
-        self.artifacts_map = {} # Loaded from manifest
+        self.artifacts_map = {} # Loaded from manifest; ecu_id -> memoryview of the staged image file
+        self.artifact_hashes = {} # ecu_id -> SHA-256 verified when the image was staged
+        self.stager = None  # Executor flashing ECUs during download (PIPELINE_INSTALL)
+        self.staging = {}   # ecu_id -> future of its pipelined stage_ecu
+        self.stage_cancel = None # Set to abort the stager's jobs
+        self.patch_tracing = 0   # Streaming patch steps running under tracemalloc
+        self.patch_tracing_lock = threading.Lock()
+        self.patch_trace_started = False # We turned tracemalloc on, so we turn it off
+        self.flash_checkpoints = {} # ecu_id -> last acknowledged offset of an unfinished flash
+        self.state_lock = threading.Lock() # ECUs flash concurrently and all checkpoint
         self.progress = {"percent": 0, "status": "Idle"}
         self.user_approved = False
+        # Worker wake-up: transitions, approvals and stop requests notify it
+        self.wakeup = threading.Condition()
+        self.pending_event = False
+        self.state_entered = time.time()
+        self.retry_at = None
+        self.runtime = AsyncAgentRuntime(self) if ASYNC_RUNTIME else None
         
         # Crypto
         # Hardcoding the public key for simulation (matches backend)
@@ -70,55 +171,103 @@ class OTAAgent:
 
         # Start Loop
         self.running = True
-        self.thread = threading.Thread(target=self.loop)
+        self.thread = threading.Thread(target=self.runtime.run if self.runtime else self.loop)
         self.thread.start()
+        self.outbox.start()
         
         # Start MQTT
         self.mqtt_listener.start()
 
     def load_state(self):
-        if os.path.exists(self.storage_path):
-            try:
-                with open(self.storage_path, 'r') as f:
-                    data = json.load(f)
-                    self.state = data.get("state", STATES["IDLE"])
-                    self.job_id = data.get("job_id")
-                    self.campaign_id = data.get("campaign_id")
-                    logging.info(f"Resumed state: {self.state}")
-            except Exception as e:
-                logging.error(f"Failed to load state: {e}")
+        try:
+            # Snapshot plus replayed journal
+            data = self.journal.load()
+            self.outbox.restore(data)
+            if data.get("state"):
+                self.state = data.get("state", STATES["IDLE"])
+                self.job_id = data.get("job_id")
+                self.campaign_id = data.get("campaign_id")
+                self.manifest = data.get("manifest")
+                self.flash_checkpoints = data.get("flash_checkpoints", {})
+                # Artifacts only live in memory: rebuild them, then flashing
+                # picks up from the checkpoints instead of offset 0
+                if self.state in (STATES["STAGED"], STATES["INSTALLING"]) and self.manifest:
+                    self.state = STATES["DOWNLOADING"]
+                logging.info(f"Resumed state: {self.state}")
+        except Exception as e:
+            logging.error(f"Failed to load state: {e}")
 
     def save_state(self):
-        data = {
-            "state": self.state,
-            "job_id": self.job_id,
-            "campaign_id": self.campaign_id
-        }
-        with open(self.storage_path, 'w') as f:
-            json.dump(data, f)
+        # Only fields that changed reach the journal; returns once they are durable
+        with self.state_lock:
+            data = {
+                "state": self.state,
+                "job_id": self.job_id,
+                "campaign_id": self.campaign_id,
+                "manifest": self.manifest,
+                "flash_checkpoints": dict(self.flash_checkpoints)
+            }
+        self.journal.update(data, sync=True)
+
+    def save_checkpoint(self, ecu_id, checkpoint):
+        """
+        Records (or clears, with None) the flashing checkpoint of an ECU.
+        Checkpoints are group-committed with others instead of written one by one.
+        """
+        with self.state_lock:
+            if checkpoint is None:
+                self.flash_checkpoints.pop(ecu_id, None)
+            else:
+                self.flash_checkpoints[ecu_id] = checkpoint
+        self.journal.update({("flash_checkpoints", ecu_id): DELETED if checkpoint is None else checkpoint})
 
     def set_state(self, new_state, details=None):
-        logging.info(f"State Transition: {self.state} -> {new_state}")
-        TRACER.log("STATE_TRANSITION", {"from": self.state, "to": new_state, "details": details})
-        self.state = new_state
-        self.progress["status"] = new_state
+        with self.wakeup:
+            old_state = self.state
+            if new_state != STATES["STOPPED"] and new_state not in TRANSITIONS.get(old_state, ()):
+                logging.error(f"Rejected State Transition: {old_state} -> {new_state}")
+                TRACER.log("STATE_TRANSITION_REJECTED", {"from": old_state, "to": new_state, "details": details})
+                return False
+            self.state = new_state
+            self.state_entered = time.time()
+            self.retry_at = None
+            logging.info(f"State Transition: {old_state} -> {new_state}")
+            TRACER.log("STATE_TRANSITION", {"from": old_state, "to": new_state, "details": details})
+            self.progress["status"] = new_state
+            # Reported under the lock so reports and heartbeats keep transition order
+            job_id = self.job_id
+            if job_id:
+                # Shipped by the outbox sender, never blocking the transition
+                self.outbox.put(job_id, new_state, details)
+            
+            # Publish Heartbeat
+            self.mqtt_listener.publish_heartbeat({
+                "state": new_state,
+                "job_id": job_id,
+                "progress": self.progress["percent"]
+            })
+            self.notify_worker()
+        if new_state == STATES["STOPPED"] and self.runtime:
+            self.runtime.cancel_phase()
         self.save_state()
-        if self.job_id:
-            self.cp_client.report_status(self.job_id, new_state, details)
-        
-        # Publish Heartbeat
-        self.mqtt_listener.publish_heartbeat({
-            "state": self.state,
-            "job_id": self.job_id,
-            "progress": self.progress["percent"]
-        })
+        return True
+
+    def notify_worker(self):
+        with self.wakeup:
+            self.pending_event = True
+            self.wakeup.notify()
+        if self.runtime:
+            self.runtime.wake()
 
     def on_mqtt_notify(self, payload):
         logging.info(f"Received Notify: {payload}")
-        if self.state in [STATES["IDLE"], STATES["SUCCEEDED"], STATES["FAILED"]]:
-            # Trigger logic to check Control Plane
-            self.campaign_candidate = payload.get("campaign_id")
-            self.set_state(STATES["NOTIFIED"])
+        with self.wakeup:
+            if STATES["NOTIFIED"] in TRANSITIONS[self.state]:
+                # Trigger logic to check Control Plane
+                self.campaign_candidate = payload.get("campaign_id")
+                self.job_id = None # The previous campaign's job must not get this campaign's reports
+                self.user_approved = False # Nor its approval
+                self.set_state(STATES["NOTIFIED"])
 
     def on_mqtt_stop(self, payload):
         logging.warning("Received Emergency Stop Signal!")
@@ -127,8 +276,7 @@ class OTAAgent:
         
         # Confirm with CP
         try:
-            policy = self.cp_client.confirm_emergency_stop(payload.get("stop_scope"), payload.get("nonce"))
-            if policy.get("active"):
+            if self.cp_client.confirm_emergency_stop(payload.get("nonce") or ""):
                 self.set_state(STATES["STOPPED"])
             else:
                 logging.info("Emergency Stop not confirmed by CP. Ignoring.")
@@ -190,131 +338,554 @@ class OTAAgent:
             self.user_approved = True
             self.simulate_failure = simulate_failure
             logging.info("User approved update.")
+            self.notify_worker()
             return True, "OK"
         return False, "Not in waiting state"
 
     def loop(self):
+        """
+        Runs the handler of the current state whenever something happens:
+        a transition, an approval, or a due retry or timeout. Otherwise it sleeps.
+        """
+        # Act on the state loaded from disk right away
+        self.notify_worker()
         while self.running:
-            time.sleep(1)
+            with self.wakeup:
+                self.wakeup.wait_for(lambda: self.pending_event or not self.running, timeout=self.next_wakeup())
+                self.pending_event = False
+            if not self.running:
+                break
+            state, handler = self.due_handler()
+            if not handler:
+                continue
             try:
-                if self.state == STATES["NOTIFIED"]:
-                    self.handle_notified()
-                elif self.state == STATES["CONFIRMING"]:
-                    self.handle_confirming()
-                elif self.state == STATES["WAITING_FOR_APPROVAL"]:
-                    if self.user_approved:
-                        self.set_state(STATES["DOWNLOADING"])
-                elif self.state == STATES["DOWNLOADING"]:
-                    self.handle_downloading()
-                elif self.state == STATES["STAGED"]:
-                    self.handle_installing() # Auto proceed to install for sim simplicity, or check local gates
-                elif self.state == STATES["INSTALLING"]:
-                    pass # Handled in handle_installing which blocks or runs async
-                elif self.state == STATES["VALIDATING"]:
-                    pass
+                getattr(self, handler)()
             except Exception as e:
                 logging.error(f"Error in Agent Loop: {e}")
-                # self.set_state(STATES["FAILED"], {"error": str(e)})
+                self.schedule_retry(state)
+
+    def due_handler(self):
+        """
+        Fails the current state if it timed out. Returns (state, handler name),
+        the name being None when there is nothing to run yet.
+        """
+        with self.wakeup:
+            state = self.state
+            timed_out = STATE_TIMEOUTS.get(state) and time.time() - self.state_entered >= STATE_TIMEOUTS[state]
+            waiting = self.retry_at is not None and time.time() < self.retry_at
+        if timed_out:
+            self.set_state(STATES["FAILED"], {"error": f"Timed out in {state}"})
+            return state, None
+        if waiting:
+            return state, None
+        # INSTALLING/VALIDATING are driven by handle_installing itself
+        return state, STATE_HANDLERS.get(state)
+
+    def schedule_retry(self, state):
+        with self.wakeup:
+            if self.state == state:
+                self.retry_at = time.time() + HANDLER_RETRY_S
+
+    def next_wakeup(self):
+        """
+        Seconds until a retry or the current state's timeout is due, None if neither.
+        """
+        due = []
+        if self.retry_at is not None:
+            due.append(self.retry_at)
+        if STATE_TIMEOUTS.get(self.state):
+            due.append(self.state_entered + STATE_TIMEOUTS[self.state])
+        return max(0, min(due) - time.time()) if due else None
+
+    def handle_waiting_for_approval(self):
+        # Woken again by approve_update
+        if self.user_approved:
+            self.set_state(STATES["DOWNLOADING"])
 
     def handle_notified(self):
         # Call CP to Confirm Eligibility and Get Job
         try:
-            self.job_id = self.cp_client.create_or_resume_job(self.campaign_candidate)
-            self.campaign_id = self.campaign_candidate
-            self.set_state(STATES["CONFIRMING"])
+            job_id = self.cp_client.create_or_resume_job(self.campaign_candidate)
         except Exception as e:
             logging.error(f"Failed to create job: {e}")
             self.set_state(STATES["IDLE"])
+            return
+        self.accept_job(job_id)
+
+    def accept_job(self, job_id):
+        self.job_id = job_id
+        self.campaign_id = self.campaign_candidate
+        self.set_state(STATES["CONFIRMING"])
+
+    def manifest_ref(self):
+        return f"manifest-{self.campaign_id}" # Simplified ref derivation
 
     def handle_confirming(self):
         # Get Manifest
         try:
-            manifest_ref = f"manifest-{self.campaign_id}" # Simplified ref derivation
-            data = self.cp_client.get_manifest(manifest_ref)
-            
-            # Verify Signature
-            manifest = data["manifest"]
-            signature = base64.b64decode(data["signature"])
-            manifest_bytes = json.dumps(manifest, sort_keys=True).encode()
-            
-            try:
-                self.backend_pub_key.verify(signature, manifest_bytes)
-                logging.info("Manifest Signature Verified.")
-            except Exception:
-                logging.error("Manifest Signature Verification FAILED!")
-                self.set_state(STATES["FAILED"], {"error": "Bad Manifest Sig"})
-                return
-
-            self.manifest = manifest
-            self.set_state(STATES["WAITING_FOR_APPROVAL"])
+            data = self.cp_client.get_manifest(self.manifest_ref())
+            self.accept_manifest(data)
         except Exception as e:
              logging.error(f"Failed to get/verify manifest: {e}")
              self.set_state(STATES["FAILED"])
 
+    def accept_manifest(self, data):
+        # Verify Signature
+        manifest = data["manifest"]
+        signature = base64.b64decode(data["signature"])
+        manifest_bytes = json.dumps(manifest, sort_keys=True).encode()
+        
+        try:
+            self.backend_pub_key.verify(signature, manifest_bytes)
+            logging.info("Manifest Signature Verified.")
+        except Exception:
+            logging.error("Manifest Signature Verification FAILED!")
+            self.set_state(STATES["FAILED"], {"error": "Bad Manifest Sig"})
+            return
+
+        self.manifest = manifest
+        self.set_state(STATES["WAITING_FOR_APPROVAL"])
+
     def handle_downloading(self):
+        targets, workers, on_progress, cancel = self.begin_downloads()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.fetch_target, t, on_progress, cancel) for t in targets]
+            errors = [e for e in (f.result() for f in as_completed(futures)) if e]
+        self.finish_downloads(errors)
+
+    def begin_downloads(self):
+        """
+        Sets up the download phase. Returns (targets, workers, on_progress, cancel)
+        for running fetch_target over the targets.
+        """
         logging.info("Starting Downloads...")
         TRACER.log("DOWNLOAD_STARTED", {"campaign_id": self.campaign_id})
         self.progress["percent"] = 10
         
         # Process targets
         # For Sim, we need to download Delta, apply to V1 (cached), verify Result V2
-        
-        v1_cache = b"A" * 4096 # Mock V1
-        
-        for target in self.manifest["targets"]:
-            ecu_id = target["ecu_id"]
-            url = target["artifact_url"]
-            expected_hash = target["artifact_hash"]
-            # Download Delta patch
-            local_path = f"/tmp/{ecu_id}_{self.campaign_id}.patch"
-            
-            if not self.downloader.download(url, local_path, None, None): # Hash check later for V2
-                self.set_state(STATES["FAILED"], {"error": "Download Failed"})
-                return
+        # Targets are independent, so they download and patch side by side;
+        # the first failure cancels the rest.
+        targets = self.manifest["targets"]
+        if PIPELINE_INSTALL:
+            self.stop_staging()
+            self.stager = ThreadPoolExecutor(max_workers=len(targets))
+            self.stage_cancel = threading.Event()
+            self.staging = {}
+        total = sum(t.get("artifact_size") or 0 for t in targets)
+        held = {}
+        lock = threading.Lock()
+        cancel = threading.Event()
 
-            # Apply Patch
-            with open(local_path, 'rb') as f:
-                patch_data = f.read()
-            
-            try:
-                v2_data = bsdiff4.patch(v1_cache, patch_data)
-                
-                # Verify V2 Hash
-                sha = hashlib.sha256(v2_data).hexdigest()
-                if sha != expected_hash:
-                    logging.error(f"Reconstructed Hash Mismatch! {sha} != {expected_hash}")
-                    self.set_state(STATES["FAILED"], {"error": "Hash Mismatch"})
-                    return
-                
-                # Store for Flashing
-                self.artifacts_map[ecu_id] = v2_data
-                logging.info(f"Artifact for {ecu_id} ready and verified.")
-                TRACER.log("ARTIFACT_VERIFIED", {"ecu_id": ecu_id, "size": len(v2_data)})
-            except Exception as e:
-                 logging.error(f"Patching failed: {e}")
-                 self.set_state(STATES["FAILED"])
-                 return
+        def on_progress(ecu_id, n):
+            # Download phase covers 10-50%, weighted by bytes across all targets
+            with lock:
+                held[ecu_id] = n
+                if total:
+                    self.progress["percent"] = 10 + int(40 * min(1.0, sum(held.values()) / total))
+
+        return targets, max(1, min(DOWNLOAD_WORKERS, len(targets))), on_progress, cancel
+
+    def finish_downloads(self, errors):
+        if errors:
+            self.set_state(STATES["FAILED"], errors[0])
+            return
 
         self.progress["percent"] = 50
         self.set_state(STATES["STAGED"])
 
+    def fetch_target(self, target, on_progress, cancel):
+        """
+        Downloads, patches and verifies one target into artifacts_map.
+        Returns None on success (or when cancelled), failure details otherwise.
+        """
+        # Cache entries this target uses stay pinned until its image is mapped,
+        # so concurrent targets can't evict them from under it
+        pins = [target["artifact_hash"]]
+        self.cache.pin(target["artifact_hash"])
+        try:
+            return self.fetch_pinned(target, on_progress, cancel, pins)
+        except ArtifactTooLarge as e:
+            logging.error(str(e))
+            cancel.set()
+            return {"error": "Artifact Too Large", "ecu_id": target["ecu_id"]}
+        except Exception as e:
+            # e.g. a full disk while caching or mapping the image
+            logging.error(f"Fetching {target['ecu_id']} failed: {e}")
+            cancel.set()
+            return {"error": "Fetch Failed", "ecu_id": target["ecu_id"]}
+        finally:
+            for sha in pins:
+                self.cache.unpin(sha)
+
+    def fetch_pinned(self, target, on_progress, cancel, pins):
+        v1_cache = b"A" * 4096 # Mock V1
+
+        ecu_id = target["ecu_id"]
+        url = target["artifact_url"]
+        expected_hash = target["artifact_hash"]
+
+        # A retried or re-issued campaign may already have the reconstructed image
+        if self.cache.check(expected_hash):
+            logging.info(f"Artifact for {ecu_id} found in cache.")
+            TRACER.log("ARTIFACT_CACHE_HIT", {"ecu_id": ecu_id, "sha256": expected_hash})
+            on_progress(ecu_id, target.get("artifact_size") or 0)
+            self.stage_artifact(ecu_id, expected_hash)
+            return None
+
+        # Download Delta patch
+        local_path = f"/tmp/{ecu_id}_{self.campaign_id}.patch"
+
+        # Size check lets a complete or partial patch from an earlier attempt be reused
+        segments = []
+        # The manifest has no patch hash; a cached patch counts only for the same URL and target image
+        patch = self.downloader.download(url, local_path, None, target.get("artifact_size"), segments, # Hash check later for V2
+                                         progress=lambda n: on_progress(ecu_id, n), cancel=cancel,
+                                         cache_key=f"{url}#{expected_hash}", keep_in_memory=not STREAMING_PATCH)
+        if cancel.is_set():
+            if patch:
+                self.cache.unpin(patch["sha256"])
+            return None # Another target failed first and reports the reason
+        if not patch:
+            cancel.set()
+            return {"error": "Download Failed", "ecu_id": ecu_id}
+        pins.append(patch["sha256"]) # Pinned by the downloader
+        if segments:
+            # Large artifact fetched as concurrent byte ranges
+            TRACER.log("DOWNLOAD_SEGMENTS", {"ecu_id": ecu_id, "url": url, "segments": segments})
+
+        if STREAMING_PATCH:
+            return self.stream_patch_target(ecu_id, v1_cache, patch, expected_hash, cancel, pins)
+
+        # Apply Patch straight from the downloaded buffer, no second read of the file
+        try:
+            v2_data = bsdiff4.patch(v1_cache, patch["data"])
+        except Exception as e:
+            logging.error(f"Patching failed: {e}")
+            cancel.set()
+            return {"error": "Patch Failed", "ecu_id": ecu_id}
+
+        # Verify V2 Hash
+        sha = hashlib.sha256(v2_data).hexdigest()
+        if sha != expected_hash:
+            logging.error(f"Reconstructed Hash Mismatch! {sha} != {expected_hash}")
+            cancel.set()
+            return {"error": "Hash Mismatch", "ecu_id": ecu_id}
+
+        # Flash from the staged file, not from this copy
+        self.cache.put(v2_data, sha)
+        logging.info(f"Artifact for {ecu_id} ready and verified.")
+        TRACER.log("ARTIFACT_VERIFIED", {"ecu_id": ecu_id, "size": len(v2_data), "patch_sha256": patch["sha256"]})
+        self.stage_artifact(ecu_id, sha)
+        return None
+
+    def stream_patch_target(self, ecu_id, v1_cache, patch, expected_hash, cancel, pins):
+        """
+        STREAMING_PATCH counterpart of the in-memory patch step of fetch_target.
+        """
+        base_sha = hashlib.sha256(v1_cache).hexdigest()
+        pins.append(base_sha)
+        self.cache.pin(base_sha)
+        if not self.cache.check(base_sha):
+            self.cache.put(v1_cache, base_sha)
+        staging_path = os.path.join(self.cache.root, f"{ecu_id}_{self.campaign_id}.staging")
+
+        heap_before = self.start_patch_trace()
+        started = time.time()
+        try:
+            result = apply_patch_file(self.cache.path(base_sha), patch["path"], staging_path)
+        except Exception as e:
+            logging.error(f"Patching failed: {e}")
+            cancel.set()
+            return {"error": "Patch Failed", "ecu_id": ecu_id}
+        finally:
+            heap_peak = self.stop_patch_trace()
+        # Hashed while written, no pass over the image
+        if result["sha256"] != expected_hash:
+            logging.error(f"Reconstructed Hash Mismatch! {result['sha256']} != {expected_hash}")
+            os.remove(staging_path)
+            cancel.set()
+            return {"error": "Hash Mismatch", "ecu_id": ecu_id}
+
+        self.cache.adopt(staging_path, expected_hash)
+        logging.info(f"Artifact for {ecu_id} ready and verified.")
+        TRACER.log("ARTIFACT_VERIFIED", {"ecu_id": ecu_id, "size": result["size"], "patch_sha256": patch["sha256"]})
+        TRACER.log("PATCH_STREAMED", {
+            "ecu_id": ecu_id,
+            "size": result["size"],
+            "seconds": round(time.time() - started, 3),
+            "chunk_bytes": PATCH_CHUNK_SIZE,
+            # Python allocations while patching, the mapped base image not included.
+            # Patch steps running at the same time share one trace.
+            "peak_heap_kb": max(heap_peak - heap_before, 0) // 1024
+        })
+        self.stage_artifact(ecu_id, expected_hash)
+        return None
+
+    def start_patch_trace(self):
+        """
+        Traces allocations while a streaming patch step runs. Returns the
+        traced memory at the start of the step.
+        """
+        with self.patch_tracing_lock:
+            if not self.patch_tracing and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.patch_trace_started = True
+            self.patch_tracing += 1
+            return tracemalloc.get_traced_memory()[0]
+
+    def stop_patch_trace(self):
+        """
+        Ends a step started with start_patch_trace. Returns the traced peak.
+        """
+        with self.patch_tracing_lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.patch_tracing -= 1
+            if not self.patch_tracing and self.patch_trace_started:
+                tracemalloc.stop()
+                self.patch_trace_started = False
+            return peak
+
+    def map_image(self, path):
+        """
+        Read-only view of a staged image file. Slices are zero-copy views, and
+        pages are loaded on demand and can be dropped again by the kernel.
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def stage_artifact(self, ecu_id, sha256):
+        # Store for Flashing: the verified image in the cache, mapped, with its hash
+        self.artifacts_map[ecu_id] = self.map_image(self.cache.path(sha256))
+        self.artifact_hashes[ecu_id] = sha256
+        if self.stager:
+            # The inactive slot can be written now, activation waits for all targets
+            self.staging[ecu_id] = self.stager.submit(self.stage_ecu, ecu_id, self.stage_cancel)
+
+    def stop_staging(self):
+        """
+        Aborts the pipelined stage jobs of an earlier download attempt and waits
+        for them, so a restaged ECU never has two flashes on its CAN IDs.
+        """
+        if self.stager:
+            self.stage_cancel.set()
+            self.stager.shutdown(wait=True, cancel_futures=True)
+            self.stager = None
+
     def handle_installing(self):
         self.set_state(STATES["INSTALLING"])
         self.progress["percent"] = 60
-        
-        # Flash Each ECU
-        # In a real agent this would be more concurrent or robust
-        for ecu_id, data in self.artifacts_map.items():
-            if not self.flash_ecu(ecu_id, data):
-                self.set_state(STATES["ROLLED_BACK"], {"reason": "ECU Flash Failed"})
+
+        prestaged = set()
+        if self.staging:
+            # Pipelined: targets were staged during download. Hold every
+            # activation until all of them are, so a failure leaves no ECU switched.
+            staged = {ecu_id: f.result() for ecu_id, f in self.staging.items()}
+            self.staging = {}
+            failed = [e for e, ok in staged.items() if not ok]
+            if failed:
+                self.set_state(STATES["ROLLED_BACK"], {"reason": f"ECU Flash Failed: {', '.join(failed)}"})
                 return
-        
+            prestaged = set(staged)
+
+        # Flash install_order groups one after another; ECUs inside a group
+        # are independent and flash concurrently on their own CAN IDs.
+        groups = self.plan_install_groups()
+        for i, (order, ecu_ids) in enumerate(groups):
+            if self.interrupted():
+                logging.error(f"Install interrupted before group {order}: {self.state}")
+                return
+            ok, reason = self.install_group(order, ecu_ids, prestaged)
+            if not ok:
+                if not self.interrupted():
+                    self.set_state(STATES["ROLLED_BACK"], {"reason": reason, "install_order": order})
+                return
+            self.progress["percent"] = 60 + int(40 * (i + 1) / len(groups))
+
         self.set_state(STATES["VALIDATING"])
         # Final confirmation
         self.set_state(STATES["SUCCEEDED"])
         self.progress["percent"] = 100
 
-    def flash_ecu(self, ecu_id, firmware_data):
+    def plan_install_groups(self):
+        """
+        Groups the staged targets by manifest install_order.
+        Returns [(install_order, [ecu_id, ...]), ...] in ascending order.
+        """
+        groups = {}
+        for target in self.manifest["targets"]:
+            if target["ecu_id"] in self.artifacts_map:
+                groups.setdefault(target.get("install_order", 1), []).append(target["ecu_id"])
+        return sorted(groups.items())
+
+    def install_group(self, order, ecu_ids, prestaged=()):
+        """
+        Installs one install_order group as a unit. All ECUs are programmed and
+        verified concurrently, then activated together; if any activation fails
+        the ECUs that already switched slots are rolled back. The group is a
+        barrier: the next one starts only after every ECU here is confirmed.
+        ECUs in prestaged were already programmed and verified by the pipeline.
+        """
+        logging.info(f"Installing group {order}: {ecu_ids}")
+        TRACER.log("INSTALL_GROUP_STARTED", {"install_order": order, "ecus": ecu_ids})
+        started = time.time()
+
+        with ThreadPoolExecutor(max_workers=len(ecu_ids)) as pool:
+            # 1. Program and verify the inactive slots
+            pending = [e for e in ecu_ids if e not in prestaged]
+            staged = dict(zip(pending, pool.map(self.stage_ecu, pending)))
+            if not all(staged.values()):
+                failed = [e for e, ok in staged.items() if not ok]
+                return False, f"ECU Flash Failed: {', '.join(failed)}"
+
+            # 2. Switch slots, unless stopped while programming
+            if self.interrupted():
+                return False, f"Install Interrupted: {self.state}"
+            activate_params = {"vehicle_id": self.vehicle_id, "simulate_failure": getattr(self, "simulate_failure", False)}
+            activated = dict(zip(ecu_ids, pool.map(lambda e: self.ecu_call(e, "activate", activate_params, 2.0), ecu_ids)))
+            if not all(activated.values()):
+                # Put the whole group back on its previous slots
+                self.rollback_group(order, ecu_ids, [e for e, ok in activated.items() if ok])
+                failed = [e for e, ok in activated.items() if not ok]
+                return False, f"ECU Activation Failed: {', '.join(failed)}"
+
+            # 3. Commit. A stop during activation must not leave the new slots running.
+            if self.interrupted():
+                self.rollback_group(order, ecu_ids, ecu_ids)
+                return False, f"Install Interrupted: {self.state}"
+            confirmed = dict(zip(ecu_ids, pool.map(lambda e: self.ecu_call(e, "confirm", {"vehicle_id": self.vehicle_id}, 1.0), ecu_ids)))
+            if not all(confirmed.values()):
+                # Every ECU here already runs the new slot, confirmed or not
+                self.rollback_group(order, ecu_ids, ecu_ids)
+                failed = [e for e, ok in confirmed.items() if not ok]
+                return False, f"ECU Confirm Failed: {', '.join(failed)}"
+
+        TRACER.log("INSTALL_GROUP_COMPLETED", {
+            "install_order": order,
+            "ecus": ecu_ids,
+            "seconds": round(time.time() - started, 3)
+        })
+        return True, "OK"
+
+    def interrupted(self):
+        # Emergency Stop, or (pipelined) another target failed to download
+        return self.state in (STATES["STOPPED"], STATES["FAILED"])
+
+    def rollback_group(self, order, ecu_ids, switched):
+        """
+        Puts the ECUs of a group that switched slots back on their previous ones.
+        """
+        for ecu_id in switched:
+            if not self.ecu_call(ecu_id, "rollback", {"vehicle_id": self.vehicle_id}, 2.0):
+                logging.error(f"ECU {ecu_id} could not be rolled back")
+        TRACER.log("INSTALL_GROUP_ROLLED_BACK", {"install_order": order, "ecus": ecu_ids})
+
+    def stage_ecu(self, ecu_id, cancel=None):
+        """
+        Flashes and verifies one ECU, retrying an interrupted transfer from its checkpoint.
+        Setting cancel aborts it at the next window.
+        """
+        for attempt in range(1, FLASH_ATTEMPTS + 1):
+            if self.flash_ecu(ecu_id, self.artifacts_map[ecu_id], cancel):
+                return True
+            if self.state in (STATES["STOPPED"], STATES["FAILED"]) or (cancel and cancel.is_set()):
+                return False
+            logging.warning(f"Flashing {ecu_id} failed (attempt {attempt}/{FLASH_ATTEMPTS})")
+        return False
+
+    def resume_offset(self, ecu_id, firmware_data, image_sha256):
+        """
+        Where an interrupted flash of this image can pick up. The ECU reports the
+        contiguous prefix it holds and its running hash; it is trusted only if that
+        hash matches our checkpoint or, failing that, our own copy of the prefix.
+        """
+        checkpoint = self.flash_checkpoints.get(ecu_id)
+        if not checkpoint or checkpoint.get("image_sha256") != image_sha256:
+            return 0
+        progress = self.ecu_call(ecu_id, "get_progress", {}, 1.0)
+        if not progress or progress.get("mode") != "PROGRAMMING" or progress.get("expected_sha256") != image_sha256:
+            return 0
+        held = progress.get("offset", 0)
+        if not progress.get("sha256") or not 0 < held <= len(firmware_data):
+            return 0
+        if held == checkpoint["offset"] and progress["sha256"] == checkpoint["prefix_sha256"]:
+            return held
+        if progress["sha256"] == hashlib.sha256(firmware_data[:held]).hexdigest():
+            return held
+        return 0
+
+    def ecu_call(self, ecu_id, method, params, timeout):
+        """
+        Request/response exchange with an ECU. Returns the response params if it
+        answered ok, None otherwise.
+        CanRPC repairs lost frames, but not a reply lost as a whole, so the call
+        is repeated on timeout; ECU methods tolerate being called twice.
+        """
+        target = CAN_IDS[ecu_id]
+        for _ in range(ACK_RETRIES):
+            # Every call is answered; drop answers to earlier attempts so they
+            # can't be mistaken for the reply to this one
+            while self.can_rpc.receive(target["rx"], timeout=0):
+                pass
+            self.can_rpc.send(target["tx"], method, params)
+            resp = self.can_rpc.receive(target["rx"], timeout=timeout)
+            if resp:
+                break
+            self.can_rpc.report_loss()
+        else:
+            logging.error(f"ECU {ecu_id} No Response to {method}")
+            return None
+        if not resp["p"].get("ok"):
+            logging.error(f"ECU {ecu_id} {method} failed: {resp['p'].get('error')}")
+            return None
+        return resp["p"]
+
+    def unchanged_blocks(self, ecu_id, firmware_data):
+        """
+        Offsets of the blocks of firmware_data the ECU's active slot already holds
+        at the same position. Empty if disabled or the ECU can't tell.
+        """
+        if not DIFFERENTIAL_FLASH:
+            return set()
+        resp = self.ecu_call(ecu_id, "block_hashes", {"block_size": BLOCK_SIZE}, 2.0)
+        if not resp or resp.get("block_size") != BLOCK_SIZE:
+            return set()
+        digests = base64.b64decode(resp["digests_b64"])
+        n = resp["digest_bytes"]
+        unchanged = set()
+        for i, pos in enumerate(range(0, min(len(firmware_data), resp["size"]), BLOCK_SIZE)):
+            if digests[i*n:(i+1)*n] == hashlib.sha256(firmware_data[pos:pos+BLOCK_SIZE]).digest()[:n]:
+                unchanged.add(pos)
+        return unchanged
+
+    def block_params(self, pos, chunk, codec, compression, z_stats):
+        """
+        Builds write_block params for one block, compressed if negotiated and worth it.
+        """
+        data = chunk
+        if compression == "zlib":
+            t = time.time()
+            z = zlib.compress(chunk, ZLIB_LEVEL)
+            z_stats["compress_s"] += time.time() - t
+            if len(z) < len(chunk):
+                data = z
+        z_stats["raw_bytes"] += len(chunk)
+        z_stats["wire_bytes"] += len(data)
+
+        if data is not chunk:
+            if codec == CODEC_BINARY:
+                return {"offset": pos, "length": len(chunk), "block_z": data}
+            return {"offset": pos, "length": len(chunk), "block_z_b64": base64.b64encode(data).decode()}
+        if codec == CODEC_BINARY:
+            return {"offset": pos, "block": chunk}
+        return {"offset": pos, "block_b64": base64.b64encode(chunk).decode()}
+
+    def flash_ecu(self, ecu_id, firmware_data, cancel=None):
+        """
+        Programs and verifies the ECU's inactive slot. Does not activate it.
+        """
         logging.info(f"Flashing {ecu_id}...")
         
         # 1. Enter Programming
@@ -326,42 +897,145 @@ class OTAAgent:
              logging.error(f"Target {ecu_id} not found in manifest")
              return False
 
+        # Verified when the image was staged; hash only images handed in directly
+        image_sha256 = self.artifact_hashes.get(ecu_id) or hashlib.sha256(firmware_data).hexdigest()
+        resume_at = self.resume_offset(ecu_id, firmware_data, image_sha256)
+
         # Mock Meta for ECU (it expects some fields from old RPC)
         meta = {
             "vehicle_id": self.vehicle_id,
             "expected_size": len(firmware_data),
-            "expected_sha256": hashlib.sha256(firmware_data).hexdigest(),
+            "expected_sha256": image_sha256,
             "expected_signature": manifest_target.get("artifact_signature", ""),
+            "codecs": [CODEC_BINARY], # Offer raw binary write_block framing
+            **FLOW_CONTROL.get(ecu_id, {"bs": 1, "st_min_ms": 0}),
+            "compression": ["zlib"] if COMPRESSION.get(ecu_id) else [],
+            "resume_offset": resume_at, # Keep what the ECU already holds up to here
         }
         
         # Send chunks
-        self.can_rpc.send(target["tx"], "enter_programming", meta)
-        ack = self.can_rpc.receive(target["rx"], timeout=2.0)
+        ack = self.ecu_call(ecu_id, "enter_programming", meta, 1.0)
         if not ack:
              logging.error(f"ECU {ecu_id} No Ack to Enter Programming")
              return False
+        # Older ECUs don't answer with a codec and only understand JSON+base64
+        codec = ack.get("codec", CODEC_JSON)
+        # ... nor flow control, in which case we fall back to stop-and-wait
+        bs = ack.get("bs", 1)
+        st_min = ack.get("st_min_ms", 0) / 1000.0
+        compression = ack.get("compression")
+        logging.info(f"ECU {ecu_id} negotiated {codec} codec, BS={bs}, STmin={st_min * 1000:.0f}ms, compression={compression}")
+        z_stats = {"raw_bytes": 0, "wire_bytes": 0, "compress_s": 0.0}
+        unchanged = self.unchanged_blocks(ecu_id, firmware_data)
 
-        off = 0
+        # The ECU confirms the resume point, or 0 if it dropped its buffer
+        off = ack.get("resume_offset", 0)
+        prefix_hasher = hashlib.sha256(firmware_data[:off])
+        if off:
+            logging.info(f"Resuming {ecu_id} at offset {off}/{len(firmware_data)}")
+            TRACER.log("FLASH_RESUMED", {"ecu_id": ecu_id, "offset": off, "size": len(firmware_data)})
+        self.save_checkpoint(ecu_id, {"image_sha256": image_sha256, "offset": off, "prefix_sha256": prefix_hasher.hexdigest()})
+
+        started = time.time()
+        resumed_from = off
         while off < len(firmware_data):
-             if self.state == STATES["STOPPED"]:
-                 logging.error("Installation interrupted by Emergency Stop")
+             # Emergency Stop, or (pipelined) another target failed to download
+             if self.state in (STATES["STOPPED"], STATES["FAILED"]):
+                 logging.error(f"Flashing {ecu_id} interrupted: {self.state}")
+                 return False
+             if cancel and cancel.is_set():
+                 logging.warning(f"Flashing {ecu_id} cancelled")
                  return False
-                 
-             chunk = firmware_data[off:off+512]
-             self.can_rpc.send(target["tx"], "write_block", {
-                 "offset": off,
-                 "block_b64": base64.b64encode(chunk).decode()
-             })
-             ack = self.can_rpc.receive(target["rx"], timeout=3.0)
+
+             # Drop acks left over from probing earlier windows
+             while self.can_rpc.receive(target["rx"], timeout=0):
+                 pass
+
+             # Fill the window (bs requests), then wait for the single ack covering it
+             pos = off
+             for i in range(bs):
+                 if pos >= len(firmware_data):
+                     break
+                 if pos in unchanged:
+                     # One request covers the whole run of blocks the ECU already has
+                     end = pos
+                     while end in unchanged:
+                         end += BLOCK_SIZE
+                     end = min(end, len(firmware_data))
+                     method, params = "copy_range", {"offset": pos, "length": end - pos}
+                 else:
+                     chunk = firmware_data[pos:pos+BLOCK_SIZE]
+                     method, params = "write_block", self.block_params(pos, chunk, codec, compression, z_stats)
+                     end = pos + len(chunk)
+                 self.can_rpc.send(target["tx"], method, params, codec=codec)
+                 pos = end
+                 if st_min and i < bs - 1 and pos < len(firmware_data):
+                     time.sleep(st_min)
+             window_end = pos
+
+             # Lost frames are repaired by CanRPC retransmission. What it can't see is a
+             # whole payload lost at the end of the stream (typically the ack itself),
+             # so probe by resending the last request: the ECU acks a block it already holds.
+             ack = None
+             for _ in range(ACK_RETRIES):
+                 deadline = time.time() + ACK_TIMEOUT
+                 while time.time() < deadline:
+                     ack = self.can_rpc.receive(target["rx"], timeout=deadline - time.time())
+                     # An ack that doesn't move past the window start is a late duplicate
+                     if not ack or not ack["p"].get("ok") or ack["p"].get("offset", window_end) > off:
+                         break
+                     ack = None
+                 if ack:
+                     break
+                 self.can_rpc.report_loss()
+                 self.can_rpc.send(target["tx"], method, params, codec=codec)
              if not ack:
                  logging.error(f"ECU {ecu_id} Write Timeout")
                  return False
-             off += len(chunk)
+             if not ack["p"].get("ok"):
+                 logging.error(f"ECU {ecu_id} rejected window at {off}: {ack['p'].get('error')}")
+                 return False
+             # The ECU reports the next offset it needs; resend from there on a short write
+             acked = ack["p"].get("offset", window_end)
+             if acked > off:
+                 prefix_hasher.update(firmware_data[off:acked])
+                 self.save_checkpoint(ecu_id, {"image_sha256": image_sha256, "offset": acked, "prefix_sha256": prefix_hasher.hexdigest()})
+             off = acked
 
-        # Verify & Activate
-        self.can_rpc.send(target["tx"], "verify", {"vehicle_id": self.vehicle_id})
-        time.sleep(1)
-        self.can_rpc.send(target["tx"], "activate", {"vehicle_id": self.vehicle_id, "simulate_failure": getattr(self, "simulate_failure", False)})
-        self.can_rpc.send(target["tx"], "confirm", {"vehicle_id": self.vehicle_id})
-        
+        elapsed = time.time() - started
+        # Only written blocks crossed the bus; copied ones were a single request each run
+        copied = sum(min(BLOCK_SIZE, len(firmware_data) - b) for b in unchanged if b >= resumed_from)
+        sent = len(firmware_data) - resumed_from - copied
+        rate = sent / elapsed if elapsed > 0 else 0
+        logging.info(f"Flashed {sent} bytes to {ecu_id} in {elapsed:.2f}s ({rate:.0f} B/s, {copied} copied on the ECU)")
+        TRACER.log("FLASH_THROUGHPUT", {
+            "ecu_id": ecu_id,
+            "bytes": sent,
+            "resumed_from": resumed_from,
+            "copied_bytes": copied, # Taken from the ECU's active slot, not sent
+            "seconds": round(elapsed, 3),
+            "bytes_per_s": round(rate),
+            "bs": bs,
+            "st_min_ms": st_min * 1000,
+            "can_mode": CAN_MODE,
+            "can_stats": dict(self.can_rpc.stats) # Bus-wide counters since gateway start
+        })
+        if compression:
+            # Estimated time saved: the same transfer at the achieved wire rate,
+            # uncompressed, minus what it actually took (compression time included)
+            ratio = z_stats["raw_bytes"] / z_stats["wire_bytes"] if z_stats["wire_bytes"] else 1.0
+            TRACER.log("FLASH_COMPRESSION", {
+                "ecu_id": ecu_id,
+                "codec": compression,
+                "raw_bytes": z_stats["raw_bytes"],
+                "wire_bytes": z_stats["wire_bytes"],
+                "ratio": round(ratio, 3),
+                "compress_s": round(z_stats["compress_s"], 3),
+                "est_saved_s": round(elapsed * (ratio - 1), 3)
+            })
+
+        # Verify the staged image; activation is up to the install group
+        if self.ecu_call(ecu_id, "verify", {"vehicle_id": self.vehicle_id}, 2.0) is None:
+            return False
+        self.save_checkpoint(ecu_id, None)
         return True
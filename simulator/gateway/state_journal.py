@@ -0,0 +1,197 @@
+import os
+import json
+import logging
+import threading
+
+# Agent state is kept as a snapshot file plus an append-only journal of the
+# fields changed since. Changes are buffered and written in group commits:
+# one write and one fsync per COMMIT_INTERVAL_S however many fields changed,
+# with later values of a field replacing earlier ones still in the buffer.
+# A synchronous update (a state transition) commits right away, taking the
+# buffered changes with it.
+# Once the journal holds COMPACT_RECORDS records, the snapshot is rewritten
+# (temp file, fsync, atomic rename) and the journal starts over.
+COMMIT_INTERVAL_S = 0.05
+COMPACT_RECORDS = 500
+
+DELETED = object() # update() value that removes an entry
+
+def copy_value(value):
+    # Callers keep mutating their dicts; keep our own copy
+    return json.loads(json.dumps(value))
+
+def valid_key(key):
+    # A field name, or [field, entry] for an entry of a dict field
+    if isinstance(key, list):
+        return len(key) == 2 and all(isinstance(k, str) for k in key)
+    return isinstance(key, str)
+
+class StateJournal:
+    def __init__(self, path, commit_interval=COMMIT_INTERVAL_S, compact_records=COMPACT_RECORDS):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.commit_interval = commit_interval
+        self.compact_records = compact_records
+        self.data = {}
+        self.seq = 0          # Last record number handed out
+        self.committed = 0    # Last record number known to be on disk
+        self.records = 0      # Records in the journal file
+        self.pending = {}     # key -> (seq, value or DELETED), not yet written
+        self.urgent = False   # A caller waits for the next commit
+        self.cond = threading.Condition()
+        self.file = None
+        self.thread = None
+
+    def load(self):
+        """
+        Reads the snapshot, replays the journal on top of it and returns the
+        recovered state. A record torn by a crash, or otherwise unreadable,
+        ends the replay and is cut off.
+        """
+        good = None # Bytes of the journal replayed, once replay got to the end
+        try:
+            try:
+                with open(self.path, 'r') as f:
+                    self.data = json.load(f)
+            except FileNotFoundError:
+                self.data = {}
+            except ValueError as e:
+                logging.error(f"State snapshot unreadable, replaying journal only: {e}")
+                self.data = {}
+            if not isinstance(self.data, dict):
+                logging.error("State snapshot is not an object, replaying journal only")
+                self.data = {}
+            snapshot_seq = self.data.pop("journal_seq", 0)
+            if not isinstance(snapshot_seq, int):
+                snapshot_seq = 0 # Replay the whole journal rather than none of it
+            self.seq = snapshot_seq
+            good = self.replay(snapshot_seq)
+        finally:
+            # Whatever went wrong above, updates must still reach disk
+            self.committed = self.seq
+            self.file = open(self.journal_path, 'ab')
+            if good is not None and self.file.tell() != good:
+                self.file.truncate(good)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return copy_value(self.data)
+
+    def replay(self, snapshot_seq):
+        """
+        Applies the journal records newer than the snapshot. Returns the length
+        of the readable part of the journal.
+        """
+        good = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("no end of line")
+                        record = json.loads(line)
+                        seq, key = record["seq"], record["key"]
+                        if not isinstance(seq, int) or not valid_key(key):
+                            raise ValueError(record)
+                        if seq > snapshot_seq:
+                            self.apply(key, record.get("value"), "value" not in record)
+                            self.seq = seq
+                    except (ValueError, TypeError, KeyError, AttributeError):
+                        logging.warning(f"Dropping unreadable state journal record at byte {good}")
+                        break
+                    good += len(line)
+                    self.records += 1
+        except FileNotFoundError:
+            pass
+        return good
+
+    def apply(self, key, value, deleted=False):
+        # key is a field name, or [field, entry] for an entry of a dict field
+        target, name = self.data, key
+        if isinstance(key, list):
+            target, name = self.data.setdefault(key[0], {}), key[1]
+        if deleted:
+            target.pop(name, None)
+        else:
+            target[name] = value
+
+    def current(self, key):
+        if isinstance(key, tuple):
+            return self.data.get(key[0], {}).get(key[1], DELETED)
+        return self.data.get(key, DELETED)
+
+    def update(self, changes, sync=False):
+        """
+        Records the fields in changes that differ from what is stored. Keys are
+        field names or (field, entry) tuples; a value of DELETED removes the entry.
+        With sync, returns once the changes are on disk.
+        """
+        with self.cond:
+            for key, value in changes.items():
+                if value is not DELETED:
+                    value = copy_value(value)
+                if self.current(key) == value:
+                    continue
+                self.apply(list(key) if isinstance(key, tuple) else key, value, value is DELETED)
+                self.seq += 1
+                self.pending.pop(key, None) # Keep write order by latest change
+                self.pending[key] = (self.seq, value)
+            target = self.seq
+            if sync and self.committed < target:
+                self.urgent = True
+                self.cond.notify_all()
+                self.cond.wait_for(lambda: self.committed >= target)
+            else:
+                self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending)
+                # Let concurrent writers join this commit
+                self.cond.wait_for(lambda: self.urgent, timeout=self.commit_interval)
+                batch, self.pending = self.pending, {}
+                upto = self.seq
+                self.urgent = False
+            self.commit(batch, upto)
+
+    def commit(self, batch, upto):
+        lines = []
+        for key, (seq, value) in batch.items():
+            record = {"seq": seq, "key": list(key) if isinstance(key, tuple) else key}
+            if value is not DELETED:
+                record["value"] = value
+            lines.append(json.dumps(record) + "\n")
+        try:
+            self.file.write("".join(lines).encode())
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.records += len(lines)
+            if self.records >= self.compact_records:
+                self.compact()
+        except OSError as e:
+            logging.error(f"Failed to write state journal: {e}")
+        with self.cond:
+            self.committed = upto
+            self.cond.notify_all()
+
+    def compact(self):
+        """
+        Folds the journal into a new snapshot. The snapshot holds every change
+        up to journal_seq, so replay skips older records still in a journal.
+        """
+        with self.cond:
+            snapshot = dict(copy_value(self.data), journal_seq=self.seq)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.records = 0
@@ -0,0 +1,153 @@
+import logging
+import threading
+from collections import deque
+
+from state_journal import DELETED
+
+# Job status reports leave through an outbox instead of being sent by the
+# transition that produced them. Events are journaled together with the
+# agent state, so they survive a restart, and a background sender ships them
+# in order per job, backing off while the control plane is unreachable.
+# The sender keeps one StreamJobStatus call open and drops each event as its
+# ack comes back; a control plane without it gets UpdateJobStatusBatch calls,
+# or unary reports as a last resort.
+OUTBOX_FIELD = "status_outbox"
+BATCH_SIZE = 50
+RETRY_S = 1.0
+RETRY_MAX_S = 30.0
+
+def event_key(event_id):
+    # Journal keys are strings; zero padding keeps them in send order
+    return (OUTBOX_FIELD, f"{event_id:010d}")
+
+class StatusOutbox:
+    def __init__(self, cp_client, journal):
+        self.cp_client = cp_client
+        self.journal = journal
+        self.events = {} # event id -> {"job_id", "status", "details"}
+        self.next_id = 0
+        self.cond = threading.Condition()
+        self.retry_s = RETRY_S
+        self.streaming = True # Until the control plane turns out not to have StreamJobStatus
+        self.batching = True  # Likewise for UpdateJobStatusBatch
+        self.running = False
+        self.thread = None
+
+    def restore(self, data):
+        """
+        Picks up the events of a loaded journal that were never acknowledged.
+        """
+        with self.cond:
+            self.events = {int(k): v for k, v in data.get(OUTBOX_FIELD, {}).items()}
+            self.next_id = max(self.events, default=-1) + 1
+        if self.events:
+            logging.info(f"Restored {len(self.events)} unsent status reports")
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def put(self, job_id, status, details=None):
+        with self.cond:
+            event_id = self.next_id
+            self.next_id += 1
+            event = {"job_id": job_id, "status": status, "details": details}
+            self.events[event_id] = event
+            self.journal.update({event_key(event_id): event})
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.events or not self.running)
+                if not self.running:
+                    return
+
+            if self.streaming:
+                ok = self.stream()
+            else:
+                with self.cond:
+                    batch = sorted(self.events.items())[:BATCH_SIZE]
+                sent = self.send(batch)
+                self.delivered(sent)
+                ok = len(sent) == len(batch)
+
+            with self.cond:
+                pending = len(self.events)
+            if not ok and pending:
+                logging.warning(f"{pending} status reports not delivered, retrying in {self.retry_s:g}s")
+                with self.cond:
+                    self.cond.wait_for(lambda: not self.running, timeout=self.retry_s)
+                self.retry_s = min(self.retry_s * 2, RETRY_MAX_S)
+            else:
+                self.retry_s = RETRY_S
+
+    def delivered(self, event_ids):
+        with self.cond:
+            for event_id in event_ids:
+                self.events.pop(event_id, None)
+        if event_ids:
+            self.journal.update({event_key(event_id): DELETED for event_id in event_ids})
+
+    def stream(self):
+        """
+        Sends events over one long-lived StreamJobStatus call as they are put,
+        dropping each once the control plane acknowledges it. Returns when the
+        call ends: False if it broke, True otherwise. Events still unacknowledged
+        are sent again, oldest first, on the next call.
+        """
+        sent = deque() # Ids on the wire; acks come back in the same order
+        closed = [False]
+
+        def updates():
+            last = -1
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: not self.running or closed[0] or max(self.events, default=-1) > last)
+                    if not self.running or closed[0]:
+                        return
+                    batch = [(i, e) for i, e in sorted(self.events.items()) if i > last]
+                for event_id, event in batch:
+                    sent.append(event_id)
+                    last = event_id
+                    yield event["job_id"], event["status"], event["details"]
+
+        result = self.cp_client.stream_status(updates(), lambda: self.delivered([sent.popleft()]))
+        with self.cond:
+            closed[0] = True # Ends the request iterator of a broken call
+            self.cond.notify_all()
+        if result is None:
+            logging.info("Control plane has no StreamJobStatus, sending batches")
+            self.streaming = False
+            return True
+        return result
+
+    def send(self, batch):
+        """
+        Sends events oldest first, in one UpdateJobStatusBatch call where the
+        control plane has it. Returns the ids delivered.
+        """
+        if self.batching:
+            received = self.cp_client.report_status_batch(
+                [(event["job_id"], event["status"], event["details"]) for _, event in batch])
+            if received is not None:
+                return [event_id for event_id, _ in batch[:received]]
+            logging.info("Control plane has no UpdateJobStatusBatch, reporting one by one")
+            self.batching = False
+
+        # A failed event holds back the later events of its job until the next round
+        sent, blocked = [], set()
+        for event_id, event in batch:
+            if event["job_id"] in blocked:
+                continue
+            if self.cp_client.report_status(event["job_id"], event["status"], event["details"]):
+                sent.append(event_id)
+            else:
+                blocked.add(event["job_id"])
+        return sent